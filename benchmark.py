@@ -0,0 +1,267 @@
+"""
+Benchmarks for the branch risk scoring hot paths.
+
+Generates synthetic workbooks (Sheet1 rules, Sheet2 branch data, Sheet3
+grades), then loads, scores, grades and prepares the dashboard views for each
+size in a fresh process, reporting wall time, peak RSS (of that process and of
+its largest scoring worker) and per-stage timings as JSON lines:
+
+    python benchmark.py --rows 1000 100000 1000000 --params 20 --text-share 0.3 -o bench.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import risk_engine
+from risk_engine import (
+    BAR_DETAIL_MAX, assign_grades, apply_rules_vectorized, build_dataset_index, category_mask, compile_grades,
+    compile_rules, get_grade, grade_histogram, open_source, page_rows, read_branch_data, read_rule_tables,
+    score_bounds, summarize_scores,
+)
+
+# ==========================================
+# 1. SYNTHETIC WORKBOOKS
+# ==========================================
+DEFAULT_ROWS = (1_000, 10_000, 100_000, 1_000_000, 5_000_000)
+EXCEL_MAX_ROWS = 1_048_575
+NUMERIC_OPS = ("<=", "<", ">=", ">")
+
+def synthetic_tables(rows, params=10, rules_per_param=4, text_share=0.2, categories=50, seed=0):
+    """
+    Builds (rules, data, grades) frames. text_share is the fraction of
+    parameters that are text columns scored with "=", "<>" and CONTAINS rules;
+    the rest are numeric columns scored with threshold rules. Every parameter
+    ends with an ELSE rule.
+    """
+    rng = np.random.default_rng(seed)
+    n_text = int(round(params * text_share))
+    data = {
+        'BranchCode': [f"{i:07d}" for i in range(rows)],
+        'Region': rng.choice(["East", "West", "North", "South", "Central"], rows),
+    }
+    rules = []
+    vocabulary = np.array([f"CAT{i:03d}" for i in range(categories)], dtype=object)
+    for p in range(params):
+        name = f"P{p:03d}"
+        if p < n_text:
+            data[name] = vocabulary[rng.integers(0, categories, rows)]
+            for r in range(rules_per_param):
+                value = vocabulary[rng.integers(0, categories)]
+                if r == rules_per_param - 1 and r > 0:
+                    rules.append((name, "<>", value, float(r + 1)))
+                elif r % 2 == 0:
+                    rules.append((name, "=", value.lower(), float(r + 1)))
+                else:
+                    rules.append((name, "CONTAINS", value[:-1], float(r + 1)))
+        else:
+            data[f"{name}%" if p % 4 == 0 else name] = rng.random(rows) * 100
+            thresholds = np.sort(rng.choice(np.arange(5, 100, 5), rules_per_param, replace=False))
+            op = NUMERIC_OPS[p % len(NUMERIC_OPS)]
+            if op.startswith(">"):
+                thresholds = thresholds[::-1]
+            for r, t in enumerate(thresholds):
+                rules.append((f"{name}%" if p % 4 == 0 else name, op, float(t), float(r)))
+        rules.append((rules[-1][0], "ELSE", None, float(rules_per_param)))
+
+    df_rules = pd.DataFrame(rules, columns=['Column Name', 'Operator', 'Value', 'Score'])
+    df_data = pd.DataFrame(data)
+    # Grade bands split a scored sample into thirds so all three grades are populated
+    unique_params = df_rules['Column Name'].unique()
+    low, high = score_bounds(compile_rules(df_rules, unique_params), df_data.columns)
+    sample = apply_rules_vectorized(df_data.head(10_000).copy(), df_rules, unique_params)
+    cuts = np.round([low, *sample['Total Score'].quantile([1 / 3, 2 / 3]), high], 2)
+    df_grades = pd.DataFrame({
+        'Min Score': [cuts[0], cuts[1] + 0.01, cuts[2] + 0.01],
+        'Max Score': [cuts[1], cuts[2], cuts[3]],
+        'Grade': ["A", "B", "C"],
+    })
+    return df_rules, df_data, df_grades
+
+def write_source(tables, path, fmt):
+    """
+    Writes the tables as an Excel workbook (path.xlsx) or as a bundle directory
+    of Parquet or CSV files. Returns the source path to score.
+    """
+    df_rules, df_data, df_grades = tables
+    if fmt == "excel":
+        if len(df_data) > EXCEL_MAX_ROWS:
+            raise ValueError(f"Excel sheets hold at most {EXCEL_MAX_ROWS:,} data rows")
+        path = path + ".xlsx"
+        # Rule values are mixed numbers and text, which is how Sheet1 reads back anyway
+        with pd.ExcelWriter(path) as writer:
+            df_rules.to_excel(writer, sheet_name="Sheet1", index=False)
+            df_data.to_excel(writer, sheet_name="Sheet2", index=False)
+            df_grades.to_excel(writer, sheet_name="Sheet3", index=False)
+        return path
+    os.makedirs(path, exist_ok=True)
+    df_rules = df_rules.assign(Value=df_rules['Value'].map(lambda v: None if v is None else str(v)))
+    for name, df in (('rules', df_rules), ('data', df_data), ('grades', df_grades)):
+        if fmt == "csv":
+            df.to_csv(os.path.join(path, f"{name}.csv"), index=False)
+        else:
+            df.to_parquet(os.path.join(path, f"{name}.parquet"), index=False)
+    return path
+
+# ==========================================
+# 2. MEASUREMENT
+# ==========================================
+def peak_rss_mb(children=False):
+    """
+    Peak RSS of this process, or with children=True of the largest finished
+    child process (the --workers scoring pool), in MB.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+PAGE_ROWS = 100  # the dashboard's default page size
+
+def render_prep(df, index):
+    """
+    The frame work the dashboard does before drawing, through the same engine
+    helpers: tab 1 summary and score chart (per-branch bars for small
+    portfolios, otherwise the per-grade histogram), the tab 2 branch list and
+    the first tab 3 report page.
+    """
+    summary = summarize_scores(df)
+    if summary['rows'] <= BAR_DETAIL_MAX:
+        rows = index['score_order']
+        chart = (df['Total Score'].to_numpy()[rows], df['BranchCode'].to_numpy()[rows],
+                 index['columns']['Final Grade']['codes'][rows])
+    else:
+        chart = grade_histogram(index, summary['hist_edges'])
+    branch_list = index['branch_list']
+    report_rows = np.flatnonzero(category_mask(index, 'Final Grade', ['A', 'B', 'C']))
+    page = df.iloc[page_rows(df, report_rows, 0, PAGE_ROWS)]
+    return summary, chart, branch_list, page
+
+def run_case(source, loader_settings=None, execution=None, legacy_grade=False):
+    """
+    Loads, scores, grades, render-preps and exports one source, timing each stage.
+    Meant to run in a fresh process so peak_rss_mb covers this case only.
+    """
+    loader_settings = dict(risk_engine.LOADER_DEFAULTS, **(loader_settings or {}))
+    stages = {}
+    start = time.perf_counter()
+
+    t = time.perf_counter()
+    reader = open_source(source, source, loader_settings)
+    df_rules, df_grades = read_rule_tables(reader)
+    df = read_branch_data(reader, df_rules, loader_settings)
+    stages['load'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    df = apply_rules_vectorized(df, df_rules, df_rules['Column Name'].unique(), **(execution or {}))
+    stages['score'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    df["Final Grade"] = assign_grades(df["Total Score"], compile_grades(df_grades))
+    stages['grade'] = time.perf_counter() - t
+
+    if legacy_grade:
+        t = time.perf_counter()
+        df["Total Score"].apply(get_grade, args=(df_grades,))
+        stages['grade_legacy'] = time.perf_counter() - t
+
+    # Built once per dataset version, when the dashboard swaps in a new snapshot
+    t = time.perf_counter()
+    index = build_dataset_index(df)
+    stages['index'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    render_prep(df, index)
+    stages['render_prep'] = time.perf_counter() - t
+
+    # The tab 3 download button serializes the whole report on every run
+    t = time.perf_counter()
+    df.to_csv(index=False)
+    stages['export'] = time.perf_counter() - t
+
+    wall_seconds = time.perf_counter() - start
+    # Scoring workers run in their own processes, which RUSAGE_SELF does not cover;
+    # the kept pool is stopped so its workers are reaped and counted
+    risk_engine.shutdown_pools()
+    return {
+        'rows': len(df),
+        'wall_seconds': wall_seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_rss_children_mb': peak_rss_mb(children=True),
+        'stages': stages,
+    }
+
+# ==========================================
+# 3. COMMAND LINE
+# ==========================================
+def environment():
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark loading, scoring, grading and render prep.")
+    parser.add_argument("--rows", type=int, nargs="+", default=list(DEFAULT_ROWS))
+    parser.add_argument("--params", type=int, default=10)
+    parser.add_argument("--rules-per-param", type=int, default=4)
+    parser.add_argument("--text-share", type=float, default=0.2,
+                        help="fraction of parameters scored with text (=, <>, CONTAINS) rules")
+    parser.add_argument("--categories", type=int, default=50, help="distinct values per text column")
+    parser.add_argument("--source-format", choices=("parquet", "csv", "excel"), default="parquet")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=risk_engine.ENGINE_DEFAULTS['workers'])
+    parser.add_argument("--partition", choices=("params", "rows"), default=risk_engine.ENGINE_DEFAULTS['partition'])
+    parser.add_argument("--legacy-grade", action="store_true", help="also time the scalar get_grade")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="append results to this JSON lines file instead of stdout")
+    args = parser.parse_args(argv)
+
+    execution = {'workers': args.workers, 'partition': args.partition}
+    config = {k: getattr(args, k) for k in ('params', 'rules_per_param', 'text_share', 'categories',
+                                            'source_format', 'workers', 'partition', 'seed')}
+    out = open(args.output, "a") if args.output else sys.stdout
+    context = multiprocessing.get_context("spawn")
+    try:
+        with tempfile.TemporaryDirectory(prefix="risk_bench_") as tmp:
+            for rows in args.rows:
+                t = time.perf_counter()
+                tables = synthetic_tables(rows, args.params, args.rules_per_param, args.text_share,
+                                          args.categories, args.seed)
+                source = write_source(tables, os.path.join(tmp, f"rows_{rows}"), args.source_format)
+                del tables
+                generate_seconds = time.perf_counter() - t
+                for run in range(args.repeat):
+                    # A fresh process per run so peak RSS is not carried over between sizes
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                        result = pool.submit(run_case, source, None, execution, args.legacy_grade).result()
+                    record = {
+                        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                        'run': run,
+                        'generate_seconds': generate_seconds,
+                        **config,
+                        **result,
+                        'environment': environment(),
+                    }
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,15 @@ import pandas as pd
 import plotly.graph_objects as go
 from datetime import datetime
 import hmac
+import time
 import numpy as np
+from risk_engine import (
+    BAR_DETAIL_MAX, CACHE_DEFAULTS, ENGINE_DEFAULTS, HISTORY_DEFAULTS, LOADER_DEFAULTS, METRICS_DEFAULTS, branch_history,
+    branch_position, branch_search_mask, cached_view, category_mask, clear_view_cache, configure_metrics, configure_view_cache, count, grade_histogram,
+    group_grade_counts, history_periods, invalidate_cache, matching_categories, metrics_snapshot, new_simulation,
+    page_rows, percentile_rank, period_migration, refresh_dataset, reset_metrics, scenario_deltas, score_range_rows, serve_metrics, shift_rule_value,
+    simulate_scenarios, stage_timer, start_refresher, summarize_scores,
+)
 
 # ==========================================
 # 1. PAGE CONFIGURATION
@@ -153,109 +161,97 @@ def check_password():
         return True
 
 # ==========================================
-# 4. OPTIMIZED CALCULATION ENGINE
+# 4. DATA LOADING
 # ==========================================
-def get_grade(score, df_grades):
+def get_settings(section, defaults):
+    """Engine defaults overridden by the matching secrets section, if any."""
+    settings = dict(defaults)
     try:
-        for _, row in df_grades.iterrows():
-            if row['Min Score'] <= score <= row['Max Score']:
-                return row['Grade']
-    except:
-        return "N/A"
-    return "N/A"
-
-def apply_rules_vectorized(df, df_rules, unique_params):
+        if section in st.secrets:
+            settings.update({k: st.secrets[section][k] for k in defaults if k in st.secrets[section]})
+    except Exception:
+        pass
+    return settings
+
+CACHE_SETTINGS = get_settings("cache", CACHE_DEFAULTS)
+LOADER_SETTINGS = get_settings("data", LOADER_DEFAULTS)
+ENGINE_SETTINGS = get_settings("engine", ENGINE_DEFAULTS)
+ENGINE_SETTINGS['workers'] = int(ENGINE_SETTINGS['workers'])
+METRICS_SETTINGS = get_settings("metrics", METRICS_DEFAULTS)
+HISTORY_SETTINGS = get_settings("history", HISTORY_DEFAULTS)
+configure_metrics(METRICS_SETTINGS['enabled'], METRICS_SETTINGS['log'])
+configure_view_cache(CACHE_SETTINGS['view_entries'])
+
+@st.cache_resource
+def start_metrics_endpoint(port, host):
+    # One scrape endpoint per server process, not per session
+    return serve_metrics(port, host)
+
+if METRICS_SETTINGS['enabled'] and int(METRICS_SETTINGS['port']):
+    start_metrics_endpoint(int(METRICS_SETTINGS['port']), METRICS_SETTINGS['host'])
+
+@st.cache_resource(show_spinner=False)
+def dataset_refresher(file_path):
     """
-    Optimized function to apply rules using vectorized operations.
+    The process-wide refresher for file_path. The first call loads the dataset;
+    afterwards a background thread re-checks the source every refresh_seconds
+    and swaps in the rescored version, so sessions never wait on a reload.
     """
-    # Initialize score columns
-    for param in unique_params:
-        if param in df.columns:
-            df[f"{param} Score"] = 0.0
-
-    # Process each parameter
-    for param in unique_params:
-        if param not in df.columns: continue
-        
-        # Get rules for this parameter
-        rules = df_rules[df_rules['Column Name'] == param]
-        
-        # Track which rows have already been assigned a score
-        is_assigned = pd.Series([False] * len(df), index=df.index)
-        
-        for _, rule in rules.iterrows():
-            op = str(rule['Operator']).strip().upper()
-            val = rule['Value']
-            score = float(rule['Score'])
-            
-            # Create mask for current rule
-            try:
-                col_data = df[param]
-                
-                if op == "ALL" or op == "ELSE":
-                    current_mask = pd.Series([True] * len(df), index=df.index)
-                elif op == ">":
-                    current_mask = pd.to_numeric(col_data, errors='coerce') > float(val)
-                elif op == "<":
-                    current_mask = pd.to_numeric(col_data, errors='coerce') < float(val)
-                elif op in [">=", "=>"]:
-                    current_mask = pd.to_numeric(col_data, errors='coerce') >= float(val)
-                elif op in ["<=", "=<"]:
-                    current_mask = pd.to_numeric(col_data, errors='coerce') <= float(val)
-                elif op == "=":
-                    is_numeric_col = pd.to_numeric(col_data, errors='coerce').notna().all()
-                    if is_numeric_col:
-                        current_mask = pd.to_numeric(col_data, errors='coerce') == float(val)
-                    else:
-                        current_mask = col_data.astype(str).str.upper().str.strip() == str(val).upper().strip()
-                elif op == "<>":
-                    current_mask = col_data.astype(str).str.upper().str.strip() != str(val).upper().strip()
-                elif op == "CONTAINS":
-                    current_mask = col_data.astype(str).str.upper().str.contains(str(val).upper().strip(), na=False)
-                else:
-                    current_mask = pd.Series([False] * len(df), index=df.index)
-                
-                # Fill NaNs with False
-                current_mask = current_mask.fillna(False)
-                
-                # Apply score to rows that match AND haven't been assigned yet
-                update_mask = current_mask & (~is_assigned)
-                if update_mask.any():
-                    df.loc[update_mask, f"{param} Score"] = score
-                    is_assigned = is_assigned | update_mask
-                
-            except Exception as e:
-                continue
-                
-    # Sum total scores
-    score_cols = [c for c in df.columns if c.endswith(" Score")]
-    df["Total Score"] = df[score_cols].sum(axis=1)
-    return df
+    count("memory_cache_miss")
+    interval = float(CACHE_SETTINGS['refresh_seconds']) if CACHE_SETTINGS['background_refresh'] else 0
+    return start_refresher(file_path, interval, CACHE_SETTINGS, LOADER_SETTINGS, ENGINE_SETTINGS, HISTORY_SETTINGS)
 
-@st.cache_data(show_spinner=False)
-def process_uploaded_file(file_path):
-    try:
-        xls = pd.ExcelFile(file_path)
-        df_rules = pd.read_excel(xls, "Sheet1")
-        df_data = pd.read_excel(xls, "Sheet2", dtype={'BranchCode': str})
-        df_grades = pd.read_excel(xls, "Sheet3")
-        
-        # Clean columns
-        df_rules.columns = [c.strip() for c in df_rules.columns]
-        df_data.columns = [c.strip() for c in df_data.columns]
-        df_grades.columns = [c.strip() for c in df_grades.columns]
-        
-        unique_params = df_rules['Column Name'].unique()
-        
-        # USE OPTIMIZED VECTORIZED FUNCTION
-        df_data = apply_rules_vectorized(df_data, df_rules, unique_params)
-        
-        # Apply Grades
-        df_data["Final Grade"] = df_data["Total Score"].apply(lambda x: get_grade(x, df_grades))
-        
-        return df_data, None
-    except Exception as e:
-        return None, str(e)
+def current_dataset(file_path):
+    """
+    The current snapshot: scored frame ('df'), lookup 'index', load 'error',
+    source modification time ('as_of') and the Sheet1/Sheet3 'rules' and 'grades'.
+    """
+    refresher = dataset_refresher(file_path)
+    snapshot = refresher['snapshot']
+    if not refresher['interval'] and time.time() - refresher['checked_at'] > float(CACHE_SETTINGS['refresh_seconds']):
+        # Without the background thread the first request after refresh_seconds re-checks the source
+        refresh_dataset(refresher)
+        snapshot = refresher['snapshot']
+    # The frame is shared by every session and treated as read-only
+    return snapshot
+
+def render_metrics_panel():
+    """Admin-only sidebar panel with the process-wide timings and counters."""
+    snapshot = metrics_snapshot()
+    with st.expander("⏱️ Performance Metrics"):
+        counters = snapshot['counters']
+        requests = counters.get('dataset_requests', 0)
+        c1, c2 = st.columns(2)
+        c1.metric("Memory cache hits", f"{requests - counters.get('memory_cache_miss', 0)}/{requests}")
+        c2.metric("Disk cache hits", f"{counters.get('cache_hit', 0)}/{counters.get('cache_hit', 0) + counters.get('cache_miss', 0)}")
+        view_hits = counters.get('view_cache_hit', 0)
+        st.metric("View cache hits", f"{view_hits}/{view_hits + counters.get('view_cache_miss', 0)}")
+        gauges = snapshot['gauges']
+        if 'frame_bytes_compact' in gauges:
+            st.metric("Compact frame", f"{gauges['frame_bytes_compact'] / 2**20:,.1f} MB",
+                      f"-{gauges['frame_bytes_saved'] / 2**20:,.1f} MB", delta_color="inverse")
+
+        if snapshot['stages']:
+            stages = pd.DataFrame.from_dict(snapshot['stages'], orient='index')
+            stages = stages[['calls', 'last_seconds', 'total_seconds', 'max_seconds']].sort_values('last_seconds', ascending=False)
+            st.markdown("**Stages (seconds)**")
+            st.dataframe(stages.style.format("{:.3f}", subset=['last_seconds', 'total_seconds', 'max_seconds']), use_container_width=True)
+
+        if snapshot['rules']:
+            rule_rows = [
+                {'Parameter': param, 'Rule': f"{rule['op']} {'' if rule['value'] is None else rule['value']}".strip(),
+                 'Score': rule['score'], 'Rows Matched': rule['matched'], 'Param Seconds': stats['last_seconds']}
+                for param, stats in snapshot['rules'].items() for rule in stats['rules']
+            ]
+            st.markdown("**Rules (last evaluation)**")
+            st.dataframe(pd.DataFrame(rule_rows), use_container_width=True, hide_index=True)
+
+        if counters:
+            st.markdown("**Counters**")
+            st.json(counters, expanded=False)
+        if st.button("Reset Metrics", use_container_width=True):
+            reset_metrics()
+            st.rerun()
 
 def get_grade_color(grade):
     colors = {
@@ -282,6 +278,191 @@ def format_value(val, col_name=""):
     
     return str(val)
 
+def score_columns(df):
+    return [c for c in df.columns if c.endswith(" Score") and c != "Total Score"]
+
+REGION_COLUMN = "Region"
+
+def branch_bar_figure(df, index, rows, height=400):
+    """Horizontal score bar per branch for row positions given in ascending score order, one trace per grade."""
+    sorted_scores, sorted_codes = df['Total Score'].to_numpy()[rows], df['BranchCode'].to_numpy()[rows]
+    grade_index = index['columns']['Final Grade']
+    sorted_grades = grade_index['codes'][rows]
+    fig_bar = go.Figure()
+    for grade in ['A', 'B', 'C']:
+        in_grade = sorted_grades == grade_index['lookup'].get(grade, -1)
+        fig_bar.add_trace(go.Bar(x=sorted_scores[in_grade], y=sorted_codes[in_grade], orientation='h', name=f'Grade {grade}', marker=dict(color=get_grade_color(grade)['primary'])))
+    fig_bar.update_layout(height=height, barmode='overlay', xaxis_title='Risk Score', yaxis_title='Branch Code')
+    return fig_bar
+
+def build_executive_view(df, index):
+    """
+    Tab 1 headline figures and grade pie for one dataset version, plus the
+    per-branch score bar chart when the portfolio is small enough to draw it.
+    """
+    summary = summarize_scores(df)
+    grade_counts = pd.Series(summary['grade_counts'], dtype='int64').sort_values(ascending=False, kind='stable')
+
+    fig_pie = go.Figure(data=[go.Pie(labels=grade_counts.index, values=grade_counts.values, hole=0.5, marker=dict(colors=['#10b981', '#f59e0b', '#ef4444']))])
+    fig_pie.update_layout(height=400, margin=dict(t=20, b=20, l=20, r=20), showlegend=True)
+
+    # Gather just the plotted columns in score order instead of sorting the whole frame
+    fig_bar = branch_bar_figure(df, index, index['score_order']) if summary['rows'] <= BAR_DETAIL_MAX else None
+    return {'summary': summary, 'grade_counts': grade_counts, 'fig_pie': fig_pie, 'fig_bar': fig_bar}
+
+def build_histogram_figure(index, edges):
+    """Stacked per-grade Total Score histogram; its size depends on the bin count only."""
+    counts = grade_histogram(index, edges)
+    centers = (np.asarray(edges[:-1]) + np.asarray(edges[1:])) / 2
+    fig = go.Figure()
+    for grade in ['A', 'B', 'C']:
+        if grade in counts:
+            fig.add_trace(go.Bar(x=centers, y=counts[grade], width=np.diff(edges), name=f'Grade {grade}', marker=dict(color=get_grade_color(grade)['primary'])))
+    fig.update_layout(height=400, barmode='stack', bargap=0, xaxis_title='Risk Score', yaxis_title='Branches')
+    return fig
+
+def build_region_figure(index, col):
+    """Stacked per-grade branch counts for each category of col."""
+    groups = group_grade_counts(index, col).sort_values('Mean Score', ascending=False)
+    fig = go.Figure()
+    for grade in ['A', 'B', 'C']:
+        if grade in groups:
+            fig.add_trace(go.Bar(x=groups[grade], y=groups.index, orientation='h', name=f'Grade {grade}', marker=dict(color=get_grade_color(grade)['primary']),
+                                 customdata=groups['Mean Score'], hovertemplate='%{y}: %{x} branches<br>Mean score %{customdata:.2f}'))
+    fig.update_layout(height=400, barmode='stack', xaxis_title='Branches', yaxis_title=col, yaxis=dict(autorange='reversed'))
+    return fig
+
+def render_drilldown(df, index, select_rows, view_key):
+    """
+    Per-branch bars for the slice select_rows() returns, in ascending score
+    order, keeping the riskiest BAR_DETAIL_MAX branches.
+    """
+    def build():
+        rows = select_rows()
+        return len(rows), branch_bar_figure(df, index, rows[-BAR_DETAIL_MAX:]) if len(rows) else None
+    total, fig = cached_view((index['version'], *view_key), build)
+    if not total:
+        st.info("No branches in this selection.")
+        return
+    if total > BAR_DETAIL_MAX:
+        st.caption(f"Showing the {BAR_DETAIL_MAX:,} highest scores of {total:,} branches")
+    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+
+def render_score_distribution(df, index, summary, executive):
+    """
+    Tab 1 score chart. Small portfolios get one bar per branch; larger ones a
+    per-grade histogram or per-region breakdown with drill-down into one bin
+    or region, so the chart payload stays bounded whatever the portfolio size.
+    """
+    if executive['fig_bar'] is not None:
+        st.plotly_chart(executive['fig_bar'], use_container_width=True, config={'displayModeBar': False})
+        return
+
+    region = index['columns'].get(REGION_COLUMN)
+    views = ["Score histogram"]
+    if region is not None and region['kind'] == "text" and len(region['categories']) <= BAR_DETAIL_MAX:
+        views.append(f"By {REGION_COLUMN.lower()}")
+    view = st.radio("View", views, horizontal=True, key="dist_view", label_visibility="collapsed")
+
+    if view == "Score histogram":
+        edges = summary['hist_edges']
+        st.plotly_chart(cached_view((index['version'], "histogram"), lambda: build_histogram_figure(index, edges)),
+                        use_container_width=True, config={'displayModeBar': False})
+        labels = [f"{lo:.2f} – {hi:.2f} ({n:,})" for lo, hi, n in zip(edges[:-1], edges[1:], summary['hist_counts'])]
+        picked = st.selectbox("Drill down into score range", ["(none)"] + [l for l, n in zip(labels, summary['hist_counts']) if n], key="dist_bin")
+        if picked != "(none)":
+            i = labels.index(picked)
+            render_drilldown(df, index, lambda: score_range_rows(index, edges[i], edges[i + 1], inclusive=i == len(labels) - 1),
+                             ("bin_bars", i))
+    else:
+        st.plotly_chart(cached_view((index['version'], "regions", REGION_COLUMN), lambda: build_region_figure(index, REGION_COLUMN)),
+                        use_container_width=True, config={'displayModeBar': False})
+        picked = st.selectbox(f"Drill down into {REGION_COLUMN.lower()}", ["(none)"] + region['categories'], key="dist_region")
+        if picked != "(none)":
+            order = index['score_order']
+            in_region = lambda: order[(region['codes'][order] == region['lookup'][picked]) & ~np.isnan(index['sorted_scores'])]
+            render_drilldown(df, index, in_region, ("region_bars", REGION_COLUMN, picked))
+
+def build_radar_figure(df, index, branch_data):
+    """Tab 2 parameter radar for one branch, scaled to the highest parameter score in the dataset."""
+    score_cols = score_columns(df)
+    max_score = cached_view((index['version'], "score_max"),
+                            lambda: max((index['columns'][c]['max'] for c in score_cols), default=0.0))
+    fig_radar = go.Figure(go.Scatterpolar(r=[branch_data[c] for c in score_cols], theta=[c.replace(" Score", "") for c in score_cols],
+                                          fill='toself', line=dict(color=get_grade_color(branch_data['Final Grade'])['primary'])))
+    fig_radar.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, max_score+5])), height=450, margin=dict(l=80, r=80, t=40, b=40))
+    return fig_radar
+
+PAGE_SIZES = [50, 100, 250, 500]
+MAX_FILTER_OPTIONS = 1000
+
+@st.cache_data(show_spinner=False)
+def column_formats(schema):
+    """Styler format strings for a (column, dtype kind) schema, computed once per schema."""
+    formats = {}
+    for col, kind in schema:
+        # Apply % formatting ONLY if '%' in name AND 'Score' NOT in name
+        if "%" in col and "Score" not in col:
+            formats[col] = "{:.2%}" # Percentage
+        elif kind == "f" or (col.endswith("Score") and kind in "iu"):
+            # Scores keep two decimals when compact mode stores them as integers
+            formats[col] = "{:.2f}" # Float
+        elif kind in "iu":
+            formats[col] = "{:.0f}" # Int
+    return formats
+
+def render_paged_table(frame, rows, key, height):
+    """
+    Shows one page of the given row positions of frame. Sorting runs
+    server-side over all of those rows; only the visible page is gathered,
+    formatted and sent to the browser.
+    """
+    total = len(rows)
+    col_sort, col_order, col_size, col_page = st.columns([2, 1, 1, 1])
+    sort_by = col_sort.selectbox("Sort by", ["(none)"] + list(frame.columns), key=f"{key}_sort")
+    ascending = col_order.selectbox("Order", ["Ascending", "Descending"], key=f"{key}_order") == "Ascending"
+    page_size = col_size.selectbox("Rows per page", PAGE_SIZES, index=1, key=f"{key}_size")
+    pages = max(1, -(-total // page_size))
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = 1
+    page = col_page.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, step=1, key=f"{key}_page")
+
+    start = (int(page) - 1) * page_size
+    window = frame.iloc[page_rows(frame, rows, start, page_size, None if sort_by == "(none)" else sort_by, ascending)]
+
+    schema = tuple((col, dtype.kind) for col, dtype in frame.dtypes.items())
+    st.caption(f"Showing rows {min(start + 1, total):,}–{min(start + page_size, total):,} of {total:,}")
+    st.dataframe(window.style.format(column_formats(schema)), use_container_width=True, height=height)
+
+MAX_SCENARIOS = 50
+
+def parse_rule_value(text):
+    """A candidate rule value as typed: a number if it parses as one, otherwise the text."""
+    text = text.strip()
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+def run_whatif(df, snapshot, param, old_value, values):
+    """
+    One scenario per candidate value for param's old_value, scored in a
+    single batch against the dataset's prepared columns. Returns a summary
+    frame and, per scenario, its migration matrix and changed branches.
+    """
+    sim = cached_view((snapshot['version'], "simulation"), lambda: new_simulation(df, snapshot['rules'], snapshot['grades']))
+    scenarios = {f"{param}: {old_value} → {v}": shift_rule_value(snapshot['rules'], param, old_value, v) for v in values}
+    results = simulate_scenarios(sim, scenarios)
+    summary = pd.DataFrame([
+        {'Scenario': name, 'Branches Moved': r['moved'], 'Scores Changed': int(np.count_nonzero(r['delta'])),
+         'Mean Delta': float(r['delta'].mean()) if len(r['delta']) else 0.0,
+         **{f"Grade {g}": int(n) for g, n in r['migration'].sum(axis=0).items()}}
+        for name, r in results.items()
+    ])
+    # Only the aggregates and changed rows are kept; full score arrays are per scenario and large
+    details = {name: {'migration': r['migration'], 'deltas': scenario_deltas(sim, r)} for name, r in results.items()}
+    return summary, details
+
 # ==========================================
 # 5. MAIN APPLICATION
 # ==========================================
@@ -302,8 +483,19 @@ if check_password():
         st.error("⚠️ Data URL missing in secrets.")
         st.stop()
 
+    if CACHE_SETTINGS['enabled']:
+        with st.sidebar:
+            if st.button("🗑️ Invalidate Data Cache", use_container_width=True):
+                invalidate_cache(CACHE_SETTINGS['dir'], DATA_URL)
+                clear_view_cache()
+                with st.spinner("🔄 Reloading data..."):
+                    refresh_dataset(dataset_refresher(DATA_URL), force=True)
+                st.rerun()
+
     with st.spinner("🔄 Fetching and processing data..."):
-        df, error = process_uploaded_file(DATA_URL)
+        count("dataset_requests")
+        snapshot = current_dataset(DATA_URL)
+        df, index, error = snapshot['df'], snapshot['index'], snapshot['error']
 
     if error:
         st.error(f"❌ Error: {error}")
@@ -312,54 +504,54 @@ if check_password():
         st.markdown(f"""
             <div class="dashboard-header">
                 <h1 class="dashboard-title">🏦 Branch Risk Analytics Platform</h1>
-                <p class="dashboard-subtitle">Real-time Risk Assessment & Portfolio Management | Last Updated: {datetime.now().strftime('%B %d, %Y')}</p>
+                <p class="dashboard-subtitle">Real-time Risk Assessment & Portfolio Management | Data as of: {datetime.fromtimestamp(snapshot['as_of']).strftime('%B %d, %Y %H:%M')}</p>
             </div>
         """, unsafe_allow_html=True)
+        last_error = dataset_refresher(DATA_URL)['last_error']
+        if last_error:
+            st.warning(f"⚠️ The latest data refresh failed, showing the previous data: {last_error}")
         
-        tab1, tab2, tab3, tab4 = st.tabs(["📊 Executive Dashboard", "🎯 Branch Analytics", "📈 Detailed Reports", "🔍 Attribute Filter"])
+        tab_names = ["📊 Executive Dashboard", "🎯 Branch Analytics", "📈 Detailed Reports", "🔍 Attribute Filter", "🧪 What-If Simulation"]
+        if HISTORY_SETTINGS['enabled']: tab_names.append("📅 History")
+        tabs = st.tabs(tab_names)
+        tab1, tab2, tab3, tab4, tab5 = tabs[:5]
 
         # TAB 1: EXECUTIVE
-        with tab1:
+        with tab1, stage_timer("render_executive"):
             col1, col2, col3, col4, col5 = st.columns(5)
-            total_branches = len(df)
+            # Shared by every session viewing this dataset version; the figures are not modified here
+            executive = cached_view((index['version'], "executive"), lambda: build_executive_view(df, index))
+            summary, grade_counts = executive['summary'], executive['grade_counts']
+            total_branches = summary['rows']
             with col1: st.metric("📍 Total Branches", f"{total_branches:,}")
-            with col2: st.metric("📊 Average Score", f"{df['Total Score'].mean():.2f}")
-            with col3: st.metric("🟢 Low Risk (A)", f"{len(df[df['Final Grade'] == 'A'])}")
-            with col4: st.metric("🟡 Medium Risk (B)", f"{len(df[df['Final Grade'] == 'B'])}")
-            with col5: st.metric("🔴 High Risk (C)", f"{len(df[df['Final Grade'] == 'C'])}")
+            with col2: st.metric("📊 Average Score", f"{summary['score_mean']:.2f}")
+            with col3: st.metric("🟢 Low Risk (A)", f"{grade_counts.get('A', 0)}")
+            with col4: st.metric("🟡 Medium Risk (B)", f"{grade_counts.get('B', 0)}")
+            with col5: st.metric("🔴 High Risk (C)", f"{grade_counts.get('C', 0)}")
 
             st.markdown("<br>", unsafe_allow_html=True)
             col_left, col_right = st.columns([1, 2])
             
             with col_left:
                 st.markdown('<div class="chart-card"><div class="chart-title">🎯 Risk Grade Distribution</div>', unsafe_allow_html=True)
-                grade_counts = df['Final Grade'].value_counts()
-                fig_pie = go.Figure(data=[go.Pie(labels=grade_counts.index, values=grade_counts.values, hole=0.5, marker=dict(colors=['#10b981', '#f59e0b', '#ef4444']))])
-                fig_pie.update_layout(height=400, margin=dict(t=20, b=20, l=20, r=20), showlegend=True)
-                st.plotly_chart(fig_pie, use_container_width=True, config={'displayModeBar': False})
+                st.plotly_chart(executive['fig_pie'], use_container_width=True, config={'displayModeBar': False})
                 st.markdown('</div>', unsafe_allow_html=True)
             
             with col_right:
                 st.markdown('<div class="chart-card"><div class="chart-title">📊 Risk Score Distribution</div>', unsafe_allow_html=True)
-                df_sorted = df.sort_values('Total Score')
-                fig_bar = go.Figure()
-                for grade in ['A', 'B', 'C']:
-                    grade_data = df_sorted[df_sorted['Final Grade'] == grade]
-                    fig_bar.add_trace(go.Bar(x=grade_data['Total Score'], y=grade_data['BranchCode'], orientation='h', name=f'Grade {grade}', marker=dict(color=get_grade_color(grade)['primary'])))
-                fig_bar.update_layout(height=400, barmode='overlay', xaxis_title='Risk Score', yaxis_title='Branch Code')
-                st.plotly_chart(fig_bar, use_container_width=True, config={'displayModeBar': False})
+                render_score_distribution(df, index, summary, executive)
                 st.markdown('</div>', unsafe_allow_html=True)
 
         # TAB 2: BRANCH ANALYTICS
-        with tab2:
+        with tab2, stage_timer("render_branch_analytics"):
             st.markdown("### 🎯 Individual Branch Deep-Dive Analysis")
             
             col_select_container, col_rest = st.columns([1, 3])
             with col_select_container:
-                branch_list = sorted(df['BranchCode'].unique())
+                branch_list = index['branch_list']
                 selected_branch = st.selectbox("🔍 Select Branch Code", branch_list)
             
-            branch_data = df[df['BranchCode'] == selected_branch].iloc[0]
+            branch_data = df.iloc[branch_position(index, selected_branch)]
             grade = branch_data['Final Grade']
             color_scheme = get_grade_color(grade)
 
@@ -371,7 +563,7 @@ if check_password():
             with col2:
                 st.markdown(f"<div style='background:white;padding:1.5rem;border-radius:12px;border-left:4px solid {color_scheme['primary']};text-align:center;'><b>Risk Grade</b><div style='font-size:2.5rem;color:{color_scheme['primary']}'>{grade}</div></div>", unsafe_allow_html=True)
             with col3:
-                percentile = (df['Total Score'] < branch_data['Total Score']).sum() / len(df) * 100
+                percentile = percentile_rank(index, branch_data['Total Score'])
                 st.markdown(f"<div style='background:white;padding:1.5rem;border-radius:12px;border-left:4px solid {color_scheme['primary']};text-align:center;'><b>Percentile Rank</b><div style='font-size:2.5rem;'>{percentile:.0f}%</div></div>", unsafe_allow_html=True)
             with col4:
                 status_text = 'LOW RISK' if grade == 'A' else 'MEDIUM RISK' if grade == 'B' else 'HIGH RISK'
@@ -380,15 +572,13 @@ if check_password():
             st.markdown("<br>", unsafe_allow_html=True)
             col_radar, col_breakdown = st.columns([1.2, 1])
             
-            score_cols = [c for c in df.columns if c.endswith(" Score") and c != "Total Score"]
+            score_cols = score_columns(df)
             scores = [branch_data[c] for c in score_cols]
             params = [c.replace(" Score", "") for c in score_cols]
 
             with col_radar:
                 st.markdown('<div class="chart-card"><div class="chart-title">🎯 Risk Parameter Breakdown</div>', unsafe_allow_html=True)
-                fig_radar = go.Figure(go.Scatterpolar(r=scores, theta=params, fill='toself', line=dict(color=color_scheme['primary'])))
-                max_score = df[score_cols].max().max()
-                fig_radar.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, max_score+5])), height=450, margin=dict(l=80, r=80, t=40, b=40))
+                fig_radar = cached_view((index['version'], "radar", selected_branch), lambda: build_radar_figure(df, index, branch_data))
                 st.plotly_chart(fig_radar, use_container_width=True, config={'displayModeBar': False})
                 st.markdown('</div>', unsafe_allow_html=True)
             
@@ -400,7 +590,7 @@ if check_password():
                 st.markdown('</div>', unsafe_allow_html=True)
 
         # TAB 3: REPORTS
-        with tab3:
+        with tab3, stage_timer("render_reports"):
             st.markdown("### 📈 Comprehensive Portfolio Data")
             col_grade, col_search, col_export = st.columns([1, 2, 1])
             with col_grade:
@@ -409,59 +599,133 @@ if check_password():
             with col_search:
                 search_term = st.text_input("🔍 Search Branch Code")
             
-            filtered_df = df[df['Final Grade'].isin(grade_filter)]
-            if search_term: filtered_df = filtered_df[filtered_df['BranchCode'].str.contains(search_term, case=False)]
+            report_mask = category_mask(index, 'Final Grade', grade_filter)
+            if search_term: report_mask &= branch_search_mask(index, search_term)
+            report_rows = np.flatnonzero(report_mask)
             
-            # MODIFICATION: Dynamic Formatting
-            report_format_dict = {}
-            for col in filtered_df.columns:
-                # Apply % formatting ONLY if '%' in name AND 'Score' NOT in name
-                if "%" in col and "Score" not in col:
-                    report_format_dict[col] = "{:.2%}" # Percentage
-                elif pd.api.types.is_float_dtype(filtered_df[col]):
-                    report_format_dict[col] = "{:.2f}" # Float
-                elif pd.api.types.is_integer_dtype(filtered_df[col]):
-                    report_format_dict[col] = "{:.0f}" # Int
-            
-            st.dataframe(filtered_df.style.format(report_format_dict), use_container_width=True, height=500)
-            if not filtered_df.empty:
-                st.download_button("📥 Download CSV", filtered_df.to_csv(index=False), "risk_report.csv", "text/csv")
+            render_paged_table(df, report_rows, "report", height=500)
+            if len(report_rows):
+                # The CSV covers the full filtered set and is only built when the button is clicked
+                st.download_button("📥 Download CSV", lambda: df.iloc[report_rows].to_csv(index=False), "risk_report.csv", "text/csv")
 
         # TAB 4: ATTRIBUTE FILTER
-        with tab4:
+        with tab4, stage_timer("render_attribute_filter"):
             st.markdown("### 🔍 Filter by Attributes")
             all_columns = df.columns.tolist()
             selected_attr = st.selectbox("Select Attribute", all_columns, key="attr_select")
             
             if selected_attr:
-                filtered_attr_df = df.copy()
-                if pd.api.types.is_numeric_dtype(df[selected_attr]):
-                    min_val, max_val = float(df[selected_attr].min()), float(df[selected_attr].max())
+                attr_index = index['columns'][selected_attr]
+                if attr_index['kind'] == "numeric":
+                    min_val, max_val = attr_index['min'], attr_index['max']
                     c1, c2 = st.columns(2)
                     min_input = c1.number_input(f"Min {selected_attr}", value=min_val)
                     max_input = c2.number_input(f"Max {selected_attr}", value=max_val)
-                    filtered_attr_df = df[(df[selected_attr] >= min_input) & (df[selected_attr] <= max_input)]
+                    filtered_attr_rows = np.flatnonzero(((df[selected_attr] >= min_input) & (df[selected_attr] <= max_input)).to_numpy())
                 else:
-                    unique_vals = df[selected_attr].astype(str).unique().tolist()
-                    selected_vals = st.multiselect(f"Select Values for {selected_attr}", unique_vals, default=unique_vals)
-                    if selected_vals: filtered_attr_df = df[df[selected_attr].astype(str).isin(selected_vals)]
-                    else: filtered_attr_df = pd.DataFrame(columns=df.columns)
+                    unique_vals = attr_index['categories']
+                    if len(unique_vals) > MAX_FILTER_OPTIONS:
+                        # Too many values to list; match them by text instead
+                        value_search = st.text_input(f"{selected_attr} contains", key="attr_contains")
+                        selected_vals = matching_categories(index, selected_attr, value_search) if value_search else unique_vals
+                    else:
+                        selected_vals = st.multiselect(f"Select Values for {selected_attr}", unique_vals, default=unique_vals)
+                    if len(selected_vals) == len(unique_vals): filtered_attr_rows = np.arange(len(df))
+                    elif selected_vals: filtered_attr_rows = np.flatnonzero(category_mask(index, selected_attr, selected_vals))
+                    else: filtered_attr_rows = np.empty(0, dtype=np.intp)
 
                 st.markdown("---")
-                if not filtered_attr_df.empty:
-                    st.markdown(f"**Found {len(filtered_attr_df)} records**")
-                    
-                    # MODIFICATION: Dynamic Formatting for Attribute Table
-                    attr_format_dict = {}
-                    for col in filtered_attr_df.columns:
-                        # Apply % formatting ONLY if '%' in name AND 'Score' NOT in name
-                        if "%" in col and "Score" not in col:
-                            attr_format_dict[col] = "{:.2%}"
-                        elif pd.api.types.is_float_dtype(filtered_attr_df[col]):
-                            attr_format_dict[col] = "{:.2f}"
-                        elif pd.api.types.is_integer_dtype(filtered_attr_df[col]):
-                            attr_format_dict[col] = "{:.0f}"
-
-                    st.dataframe(filtered_attr_df.style.format(attr_format_dict), use_container_width=True, height=600)
+                if len(filtered_attr_rows):
+                    st.markdown(f"**Found {len(filtered_attr_rows)} records**")
+                    render_paged_table(df, filtered_attr_rows, "attr", height=600)
                 else:
                     st.warning("No records found.")
+
+        # TAB 5: WHAT-IF SIMULATION
+        with tab5, stage_timer("render_whatif"):
+            st.markdown("### 🧪 What-If Rule Simulation")
+            rules = snapshot['rules']
+            if rules is None:
+                st.info("Rule tables are not available for this dataset.")
+            else:
+                params = [p for p in rules['Column Name'].dropna().unique() if p in df.columns]
+                c1, c2, c3 = st.columns([1, 1, 2])
+                whatif_param = c1.selectbox("Parameter", params, key="whatif_param")
+                param_values = [v for v in rules.loc[rules['Column Name'] == whatif_param, 'Value'].dropna().unique()]
+                old_value = c2.selectbox("Rule value to change", param_values, key="whatif_value")
+                candidates = c3.text_input("Candidate values (comma separated)", key="whatif_candidates",
+                                           placeholder="e.g. 0.04, 0.045, 0.055")
+                if st.button("▶️ Run Simulation", disabled=old_value is None):
+                    values = [parse_rule_value(v) for v in candidates.split(",") if v.strip()][:MAX_SCENARIOS]
+                    st.session_state["whatif_run"] = (whatif_param, old_value, tuple(values))
+
+                run = st.session_state.get("whatif_run")
+                if run and run[2]:
+                    param, old_value, values = run
+                    summary, details = cached_view((index['version'], "whatif", param, repr(old_value), values),
+                                                   lambda: run_whatif(df, snapshot, param, old_value, values))
+                    st.dataframe(summary.style.format({'Mean Delta': "{:+.2f}"}), use_container_width=True, hide_index=True)
+                    scenario = st.selectbox("Scenario", summary['Scenario'], key="whatif_scenario")
+                    col_matrix, col_deltas = st.columns([1, 2])
+                    with col_matrix:
+                        st.markdown("**Grade migration (baseline → scenario)**")
+                        st.dataframe(details[scenario]['migration'], use_container_width=True)
+                    with col_deltas:
+                        deltas = details[scenario]['deltas']
+                        st.markdown(f"**Branches with a changed score or grade: {len(deltas):,}**")
+                        if len(deltas):
+                            render_paged_table(deltas, np.arange(len(deltas)), "whatif", height=400)
+
+        # TAB 6: HISTORY
+        if HISTORY_SETTINGS['enabled']:
+            with tabs[5], stage_timer("render_history"):
+                store = HISTORY_SETTINGS['dir']
+                periods = history_periods(store)
+                # Views are keyed on the stored versions, so a new snapshot is picked up on the next run
+                store_key = tuple((period, entry['version']) for period, entry in periods.items())
+                if not periods:
+                    st.info("No snapshots stored yet. One is saved each time the data is refreshed.")
+                else:
+                    st.markdown("### 📅 Branch Score Trend")
+                    col_branch, col_trend = st.columns([1, 3])
+                    with col_branch:
+                        history_branch = st.selectbox("🔍 Select Branch Code", index['branch_list'], key="history_branch")
+                    trend = cached_view((index['version'], "history_trend", store_key, history_branch),
+                                        lambda: branch_history(store, history_branch))
+                    with col_trend:
+                        if len(trend):
+                            fig_trend = go.Figure(go.Scatter(x=trend.index, y=trend['Total Score'], mode='lines+markers', text=trend['Final Grade'],
+                                                             marker=dict(size=12, color=[get_grade_color(g)['primary'] for g in trend['Final Grade']]),
+                                                             line=dict(color='#667eea'), hovertemplate='%{x}: %{y:.2f} (Grade %{text})'))
+                            fig_trend.update_layout(height=350, xaxis_title='Period', yaxis_title='Risk Score', xaxis_type='category')
+                            st.plotly_chart(fig_trend, use_container_width=True, config={'displayModeBar': False})
+                        else:
+                            st.info("This branch has no stored history.")
+                    if len(trend):
+                        st.dataframe(trend.drop(columns=['BranchCode']), use_container_width=True)
+
+                    st.markdown("### 🔀 Grade Migration Between Periods")
+                    period_list = list(periods)
+                    if len(period_list) < 2:
+                        st.info("Grade migration needs snapshots from at least two periods.")
+                    else:
+                        c1, c2 = st.columns(2)
+                        from_period = c1.selectbox("From period", period_list, index=len(period_list) - 2, key="history_from")
+                        to_period = c2.selectbox("To period", period_list, index=len(period_list) - 1, key="history_to")
+                        migration = cached_view((index['version'], "history_migration", store_key, from_period, to_period),
+                                                lambda: period_migration(store, from_period, to_period))
+                        m1, m2, m3 = st.columns(3)
+                        m1.metric("Grade changes", f"{len(migration['changes']):,}")
+                        m2.metric("New branches", f"{migration['new']:,}")
+                        m3.metric("Exited branches", f"{migration['exited']:,}")
+                        col_matrix, col_changes = st.columns([1, 2])
+                        with col_matrix:
+                            st.markdown(f"**{from_period} → {to_period}**")
+                            st.dataframe(migration['matrix'], use_container_width=True)
+                        with col_changes:
+                            if len(migration['changes']):
+                                render_paged_table(migration['changes'], np.arange(len(migration['changes'])), "migration", height=400)
+
+    if METRICS_SETTINGS['enabled'] and st.session_state.get("user_role") == "Administrator":
+        with st.sidebar:
+            render_metrics_panel()
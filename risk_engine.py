@@ -0,0 +1,2359 @@
+"""
+Branch risk scoring engine.
+
+Scores branch data (Sheet2) against the rule table (Sheet1), grades the
+totals with the grade bands (Sheet3) and loads, caches and streams scored
+datasets. It has no Streamlit dependency, so it can be imported by the
+dashboard, by batch jobs and by tests, or run directly as a CLI:
+
+    python risk_engine.py workbooks/ -o scored/ --jobs 4
+"""
+import contextlib
+import email.utils
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 1. INSTRUMENTATION
+# ==========================================
+# Process-wide stage timings, counters and per-rule statistics. Everything is
+# off by default; when disabled a timer is a shared no-op context manager and
+# rule match counts are never computed.
+METRICS_DEFAULTS = {
+    'enabled': False,
+    'log': False,
+    'port': 0,
+    # Loopback only by default: the scrape output includes the rule thresholds
+    'host': "127.0.0.1",
+}
+_metrics = {'enabled': False, 'log': False, 'stages': {}, 'counters': {}, 'gauges': {}, 'rules': {}}
+_metrics_lock = threading.Lock()
+_NO_TIMER = contextlib.nullcontext()
+logger = logging.getLogger("risk_engine")
+
+def configure_metrics(enabled=True, log=False):
+    """
+    Turns collection on or off. With log=True every timing is also emitted as a
+    JSON log line on the "risk_engine" logger.
+    """
+    _metrics['enabled'] = bool(enabled)
+    _metrics['log'] = bool(enabled and log)
+    if _metrics['log'] and not logger.handlers and not logging.getLogger().handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
+
+def metrics_enabled():
+    return _metrics['enabled']
+
+def reset_metrics():
+    with _metrics_lock:
+        for group in ('stages', 'counters', 'gauges', 'rules'):
+            _metrics[group] = {}
+
+def _log_event(event, **fields):
+    if _metrics['log']:
+        logger.info(json.dumps({'event': event, **fields}, default=str))
+
+def record_timing(stage, seconds, **fields):
+    with _metrics_lock:
+        stats = _metrics['stages'].setdefault(stage, {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        stats['calls'] += 1
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        stats['last_seconds'] = seconds
+    _log_event('stage', stage=stage, seconds=round(seconds, 6), **fields)
+
+@contextlib.contextmanager
+def _timed(stage, fields):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(stage, time.perf_counter() - start, **fields)
+
+def stage_timer(stage, **fields):
+    """
+    Context manager that records how long its block takes under stage.
+    """
+    if not _metrics['enabled']:
+        return _NO_TIMER
+    return _timed(stage, fields)
+
+def count(counter, n=1):
+    if not _metrics['enabled']:
+        return
+    with _metrics_lock:
+        _metrics['counters'][counter] = _metrics['counters'].get(counter, 0) + n
+    _log_event('count', counter=counter, n=n)
+
+def set_gauge(gauge, value):
+    if not _metrics['enabled']:
+        return
+    with _metrics_lock:
+        _metrics['gauges'][gauge] = value
+    _log_event('gauge', gauge=gauge, value=value)
+
+def record_rule_stats(param, seconds, rules, matched, rows):
+    """
+    Stores one parameter's evaluation time and the rows each of its rules
+    scored (first match wins; None where the rule never applies).
+    """
+    with _metrics_lock:
+        stats = _metrics['rules'].setdefault(param, {'calls': 0, 'total_seconds': 0.0})
+        stats['calls'] += 1
+        stats['total_seconds'] += seconds
+        stats['last_seconds'] = seconds
+        stats['rows'] = rows
+        stats['rules'] = [{'op': op, 'value': None if pd.isna(val) else val, 'score': score, 'matched': m}
+                          for (op, val, score), m in zip(rules, matched)]
+    _log_event('rules', param=param, seconds=round(seconds, 6), rows=rows, matched=matched)
+
+def metrics_snapshot():
+    with _metrics_lock:
+        return json.loads(json.dumps({k: _metrics[k] for k in ('stages', 'counters', 'gauges', 'rules')}, default=str))
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def metrics_text():
+    """
+    The current metrics in the Prometheus text exposition format.
+    """
+    snapshot = metrics_snapshot()
+    lines = []
+    for stage, stats in snapshot['stages'].items():
+        lines.append(f'risk_stage_calls_total{{stage="{_label(stage)}"}} {stats["calls"]}')
+        lines.append(f'risk_stage_seconds_total{{stage="{_label(stage)}"}} {stats["total_seconds"]:.6f}')
+        lines.append(f'risk_stage_last_seconds{{stage="{_label(stage)}"}} {stats["last_seconds"]:.6f}')
+    for counter, n in snapshot['counters'].items():
+        lines.append(f'risk_events_total{{counter="{_label(counter)}"}} {n}')
+    for gauge, value in snapshot['gauges'].items():
+        lines.append(f'risk_gauge{{gauge="{_label(gauge)}"}} {value}')
+    for param, stats in snapshot['rules'].items():
+        lines.append(f'risk_rule_seconds_total{{param="{_label(param)}"}} {stats["total_seconds"]:.6f}')
+        for i, rule in enumerate(stats['rules']):
+            if rule['matched'] is not None:
+                lines.append(f'risk_rule_matched_rows{{param="{_label(param)}",rule="{i}",'
+                             f'op="{_label(rule["op"])}",value="{_label(rule["value"])}"}} {rule["matched"]}')
+    return "\n".join(lines) + "\n"
+
+def serve_metrics(port, host="127.0.0.1"):
+    """
+    Serves metrics_text() at /metrics from a daemon thread. Returns the server.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ==========================================
+# 2. CALCULATION ENGINE
+# ==========================================
+def get_grade(score, df_grades):
+    try:
+        for _, row in df_grades.iterrows():
+            if row['Min Score'] <= score <= row['Max Score']:
+                return row['Grade']
+    except:
+        return "N/A"
+    return "N/A"
+
+def _is_number(value):
+    return isinstance(value, (int, float, np.integer, np.floating, np.bool_))
+
+def compile_grades(df_grades):
+    """
+    Compiles Sheet3 into sorted band edges and the grade that wins in each band.
+    Rows are resolved in sheet order, so gaps, overlaps and malformed rows map
+    to the same grade (or "N/A") that get_grade returns for the score.
+    """
+    intervals = []
+    try:
+        rows = list(zip(df_grades['Min Score'], df_grades['Max Score'], df_grades['Grade']))
+    except KeyError:
+        rows = [(None, None, "N/A")]
+    for low, high, grade in rows:
+        if not _is_number(low):
+            # get_grade gives up with "N/A" at the first bound it cannot compare
+            intervals.append((-np.inf, np.inf, "N/A"))
+            break
+        if not _is_number(high):
+            intervals.append((float(low), np.inf, "N/A"))
+            continue
+        intervals.append((float(low), float(high), grade))
+
+    labels = []
+    for _, _, grade in intervals:
+        if not pd.isna(grade) and grade not in labels:
+            labels.append(grade)
+    if "N/A" not in labels:
+        labels.append("N/A")
+    codes = [labels.index(grade) if not pd.isna(grade) else -1 for _, _, grade in intervals]
+
+    bounds = [b for low, high, _ in intervals for b in (low, high)]
+    edges = np.unique([b for b in bounds if not np.isnan(b)])
+    reps = _band_representatives(edges)
+    band_codes = np.select(
+        [(low <= reps) & (reps <= high) for low, high, _ in intervals],
+        codes,
+        default=labels.index("N/A"),
+    ) if intervals else np.full(len(reps), labels.index("N/A"))
+    return {'edges': edges, 'band_codes': band_codes, 'labels': labels}
+
+def assign_grades(scores, grade_plan):
+    """
+    Grades a whole score column in one searchsorted call and returns it as a categorical.
+    """
+    values = pd.Series(scores).to_numpy(dtype='float64', na_value=np.nan)
+    codes = grade_plan['band_codes'][_band_index(grade_plan['edges'], values)]
+    codes = np.where(np.isnan(values), grade_plan['labels'].index("N/A"), codes)
+    grades = pd.Categorical.from_codes(codes, categories=pd.Index(grade_plan['labels']))
+    return pd.Series(grades, index=getattr(scores, 'index', None)).cat.remove_unused_categories()
+
+NUMERIC_OPS = {
+    ">": np.greater,
+    "<": np.less,
+    ">=": np.greater_equal,
+    "=>": np.greater_equal,
+    "<=": np.less_equal,
+    "=<": np.less_equal,
+}
+MATCH_ALL_OPS = ("ALL", "ELSE")
+TEXT_OPS = ("=", "<>")
+
+def compile_rules(df_rules, unique_params):
+    """
+    Groups Sheet1 once into an ordered list of (operator, value, score) per parameter.
+    Rule order inside each list is the sheet order, so first match still wins.
+    """
+    plan = {param: [] for param in unique_params}
+    # One pass over the sheet rather than a boolean filter per parameter
+    for param, op, val, score in zip(df_rules['Column Name'], df_rules['Operator'], df_rules['Value'], df_rules['Score']):
+        if not pd.isna(param) and param in plan:
+            plan[param].append((str(op).strip().upper(), val, score))
+    return plan
+
+def prepare_column(col_data, ops, is_numeric=None):
+    """
+    Coerces and normalizes a data column once for every rule that references it.
+    Text is factorized so string rules are evaluated per distinct value, not per row.
+    is_numeric overrides the column-wide check that decides how "=" compares,
+    which lets a subset of rows be scored exactly as it would be in the full column.
+    """
+    prepared = {'n': len(col_data), 'numeric': None}
+    try:
+        if col_data.dtype == object or pd.api.types.is_string_dtype(col_data.dtype):
+            # Text columns are coerced per distinct value and broadcast back through the codes
+            codes, uniques = pd.factorize(col_data)
+            numeric = pd.to_numeric(pd.Series(uniques, dtype=object), errors='coerce')
+            numeric = np.append(pd.Series(numeric).to_numpy(dtype='float64', na_value=np.nan), np.nan)[codes]
+        else:
+            numeric = pd.to_numeric(col_data, errors='coerce')
+            numeric = pd.Series(numeric).to_numpy(dtype='float64', na_value=np.nan)
+        prepared['numeric'] = numeric
+        prepared['is_numeric'] = not np.isnan(numeric).any()
+    except Exception:
+        pass
+    if is_numeric is not None and prepared['numeric'] is not None:
+        prepared['is_numeric'] = is_numeric
+
+    needs_text = "<>" in ops or ("=" in ops and not prepared.get('is_numeric', False))
+    if needs_text or "CONTAINS" in ops:
+        try:
+            upper = col_data.astype(str).str.upper()
+            if "CONTAINS" in ops:
+                prepared['contains'] = pd.factorize(upper)
+            if needs_text:
+                prepared['text'] = pd.factorize(upper.str.strip())
+        except Exception:
+            pass
+    return prepared
+
+def _rule_mask(prepared, op, val):
+    # Returns a boolean array for one rule, or None when the rule cannot be evaluated
+    n = prepared['n']
+    numeric = prepared['numeric']
+    if op in MATCH_ALL_OPS:
+        return np.ones(n, dtype=bool)
+    if op in NUMERIC_OPS or (op == "=" and prepared.get('is_numeric')):
+        if numeric is None: return None
+        return NUMERIC_OPS.get(op, np.equal)(numeric, float(val))
+    if op in TEXT_OPS:
+        if 'text' not in prepared: return None
+        codes, uniques = prepared['text']
+        pos = uniques.get_indexer([str(val).upper().strip()])[0]
+        if pos < 0:
+            return np.full(n, op == "<>")
+        return codes == pos if op == "=" else codes != pos
+    if op == "CONTAINS":
+        if 'contains' not in prepared: return None
+        codes, uniques = prepared['contains']
+        hits = pd.Series(uniques, dtype=object).str.contains(str(val).upper().strip(), na=False)
+        hits = np.append(hits.to_numpy(dtype=bool), False)
+        return hits[codes]
+    return np.zeros(n, dtype=bool)
+
+def _band_representatives(edges):
+    # Band 2i is the open interval below edges[i] (2k is above the last edge), band 2i+1 is edges[i] itself
+    k = len(edges)
+    reps = np.empty(2 * k + 1)
+    reps[1::2] = edges
+    if k:
+        reps[0] = np.nextafter(edges[0], -np.inf)
+        reps[2::2] = np.nextafter(edges, np.inf)
+    else:
+        reps[0] = 0.0
+    return reps
+
+def _band_index(edges, values):
+    # Places every value in its band with a single searchsorted (NaN lands in the last band)
+    k = len(edges)
+    if not k:
+        return np.zeros(len(values), dtype=np.intp)
+    idx = np.searchsorted(edges, values, side='left')
+    is_edge = edges[np.minimum(idx, k - 1)] == values
+    return 2 * idx + is_edge
+
+def _score_numeric_bands(numeric, rules):
+    # Pure threshold tables: evaluate the rules once per band between sorted
+    # thresholds, then look every row up by its band.
+    thresholds = []
+    for op, val, _ in rules:
+        if op not in MATCH_ALL_OPS:
+            thresholds.append(float(val))
+    edges = np.unique([t for t in thresholds if not np.isnan(t)])
+    reps = _band_representatives(edges)
+
+    band_conds, nan_score = [], None
+    for op, val, score in rules:
+        if op in MATCH_ALL_OPS:
+            band_conds.append((np.ones(len(reps), dtype=bool), score))
+            if nan_score is None: nan_score = score
+        else:
+            band_conds.append((NUMERIC_OPS.get(op, np.equal)(reps, float(val)), score))
+    band_scores = np.select([c for c, _ in band_conds], [s for _, s in band_conds], default=0.0)
+
+    result = band_scores[_band_index(edges, numeric)]
+    return np.where(np.isnan(numeric), 0.0 if nan_score is None else nan_score, result)
+
+def _valid_rules(prepared, rules):
+    # Returns (position, op, val, score) for the rules that can apply to this column
+    valid = []
+    for i, (op, val, score) in enumerate(rules):
+        score = float(score)
+        try:
+            if op in NUMERIC_OPS or (op == "=" and prepared.get('is_numeric')):
+                if prepared['numeric'] is None: continue
+                float(val)
+            elif op not in MATCH_ALL_OPS + TEXT_OPS + ("CONTAINS",):
+                continue
+        except (TypeError, ValueError):
+            continue
+        valid.append((i, op, val, score))
+    return valid
+
+def score_column(prepared, rules):
+    """
+    Scores one prepared column against its compiled rules with first-match-wins semantics.
+    """
+    valid = [rule[1:] for rule in _valid_rules(prepared, rules)]
+
+    banded = all(op in NUMERIC_OPS or op in MATCH_ALL_OPS or op == "=" for op, _, _ in valid)
+    if banded and (prepared.get('is_numeric') or all(op != "=" for op, _, _ in valid)) \
+            and valid and prepared['numeric'] is not None:
+        return _score_numeric_bands(prepared['numeric'], valid)
+
+    conds, choices = [], []
+    for op, val, score in valid:
+        try:
+            mask = _rule_mask(prepared, op, val)
+        except Exception:
+            continue
+        if mask is not None:
+            conds.append(mask)
+            choices.append(score)
+    if not conds:
+        return np.zeros(prepared['n'])
+    return np.select(conds, choices, default=0.0)
+
+def rule_match_counts(prepared, rules):
+    """
+    Rows scored by each rule under first-match-wins, in rule order. Rules that
+    cannot apply to the column count as None. Only used for instrumentation.
+    """
+    matched = [None] * len(rules)
+    remaining = np.ones(prepared['n'], dtype=bool)
+    for i, op, val, _ in _valid_rules(prepared, rules):
+        try:
+            mask = _rule_mask(prepared, op, val)
+        except Exception:
+            continue
+        if mask is None:
+            continue
+        matched[i] = int(np.count_nonzero(mask & remaining))
+        remaining &= ~mask
+    return matched
+
+def equality_modes(df, plan):
+    """
+    Returns, per parameter with an "=" rule, whether its column compares numerically.
+    """
+    modes = {}
+    for param, rules in plan.items():
+        if param in df.columns and any(op == "=" for op, _, _ in rules):
+            modes[param] = bool(prepare_column(df[param], {"="}).get('is_numeric', False))
+    return modes
+
+# ------------------------------------------
+# Parallel execution
+# ------------------------------------------
+# Rule columns are copied once into shared memory (numeric columns as raw
+# values, plain text columns as dictionary codes) and a pool of worker
+# processes scores them by parameter or by row shard, writing straight into a
+# shared output block. Columns that cannot be rebuilt exactly in another
+# process are scored in the parent, so results match the serial path exactly.
+# The pool is started once per (workers, start_method) and kept for later calls;
+# frames below min_parallel_rows are scored serially, where a pool costs more
+# than it saves.
+ENGINE_DEFAULTS = {
+    'workers': 1,
+    'partition': "params",
+    'start_method': "spawn",
+    'min_parallel_rows': 50_000,
+}
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _scoring_pool(workers, start_method):
+    with _pools_lock:
+        pool = _pools.get((workers, start_method))
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+            if not _pools:
+                # A process started by multiprocessing (a CLI job) joins its children on
+                # exit before any atexit hook could stop the pool, so stop it first, ahead
+                # of the exitpriority=10 finalizers that close the pool's queues
+                multiprocessing.util.Finalize(None, shutdown_pools, exitpriority=100)
+            _pools[(workers, start_method)] = pool
+        return pool
+
+def shutdown_pools():
+    """
+    Stops the scoring pools kept by apply_rules_vectorized. The next parallel call starts a new one.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+def _attach_shared(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always tracks; pool workers share the parent's tracker,
+        # which already holds the name, so the parent's unlink still cleans up
+        return shared_memory.SharedMemory(name=name)
+
+def _share_column(col_data):
+    dtype = col_data.dtype
+    if isinstance(dtype, np.dtype) and dtype.kind in "biuf":
+        values = col_data.to_numpy()
+        spec = {'kind': 'values'}
+    elif pd.api.types.is_string_dtype(dtype) and pd.api.types.infer_dtype(col_data, skipna=True) in ("string", "empty"):
+        if dtype == object and not all(isinstance(v, float) for v in col_data[col_data.isna()]):
+            return None, None
+        codes, uniques = pd.factorize(col_data)
+        values = codes
+        spec = {'kind': 'codes', 'uniques': np.append(np.asarray(uniques, dtype=object), np.nan), 'series_dtype': dtype}
+    else:
+        return None, None
+    block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+    spec.update(name=block.name, dtype=values.dtype.str, n=len(values))
+    return block, spec
+
+def _shared_array(blocks, name, shape, dtype):
+    if name not in blocks:
+        blocks[name] = _attach_shared(name)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=blocks[name].buf)
+
+def _score_shared_task(task):
+    # The pool outlives a single call, so each task carries its call's state and
+    # detaches from the shared blocks before returning
+    state, params, start, stop = task
+    output = state['output']
+    stats, blocks = {}, {}
+    try:
+        for param in params:
+            began = time.perf_counter()
+            spec = state['specs'][param]
+            values = _shared_array(blocks, spec['name'], (spec['n'],), spec['dtype'])[start:stop]
+            if spec['kind'] == 'values':
+                col_data = pd.Series(values.copy())
+            else:
+                col_data = pd.Series(spec['uniques'][values], dtype=spec['series_dtype'])
+            rules = state['plan'][param]
+            prepared = prepare_column(col_data, {op for op, _, _ in rules}, state['numeric_modes'].get(param))
+            scores = _shared_array(blocks, output['name'], output['shape'], 'float64')
+            scores[output['rows'][param], start:stop] = score_column(prepared, rules)
+            del values, scores, col_data
+            if state['detail']:
+                stats[param] = (time.perf_counter() - began, rule_match_counts(prepared, rules))
+    finally:
+        for block in blocks.values():
+            block.close()
+    return stats
+
+def _score_params_parallel(df, plan, params, numeric_modes, workers, partition, start_method, detail=False):
+    """
+    Scores params on a process pool and returns ({param: score array}, stats).
+    With detail=True, stats maps each param to (seconds, rule match counts),
+    summed over row shards.
+    """
+    blocks, specs, results, stats = [], {}, {}, {}
+    try:
+        for param in params:
+            block, spec = _share_column(df[param])
+            if block is not None:
+                blocks.append(block)
+                specs[param] = spec
+        shared = [p for p in params if p in specs]
+        n = len(df)
+        out_block = shared_memory.SharedMemory(create=True, size=max(len(shared) * n * 8, 1))
+        blocks.append(out_block)
+        output = {'name': out_block.name, 'shape': (len(shared), n), 'rows': {p: i for i, p in enumerate(shared)}}
+
+        def state(names):
+            return {'specs': {p: specs[p] for p in names}, 'plan': {p: plan.get(p, []) for p in names},
+                    'numeric_modes': {p: numeric_modes.get(p) for p in names}, 'output': output, 'detail': detail}
+        if partition == "rows":
+            bounds = np.linspace(0, n, min(workers, max(n, 1)) + 1).astype(int)
+            tasks = [(state(shared), shared, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        else:
+            tasks = [(state([param]), [param], 0, n) for param in shared]
+
+        pool = _scoring_pool(workers, start_method)
+        futures = [pool.submit(_score_shared_task, task) for task in tasks]
+        # Columns that could not be shared are scored here while the pool works
+        for param in params:
+            if param not in specs:
+                began = time.perf_counter()
+                rules = plan.get(param, [])
+                prepared = prepare_column(df[param], {op for op, _, _ in rules}, numeric_modes.get(param))
+                results[param] = score_column(prepared, rules)
+                if detail:
+                    stats[param] = (time.perf_counter() - began, rule_match_counts(prepared, rules))
+        try:
+            for future in futures:
+                for param, (seconds, matched) in future.result().items():
+                    if param in stats:
+                        total, so_far = stats[param]
+                        matched = [None if a is None else a + b for a, b in zip(so_far, matched)]
+                        seconds += total
+                    stats[param] = (seconds, matched)
+        except BrokenProcessPool:
+            # A dead worker breaks the whole pool; the next call starts a fresh one
+            with _pools_lock:
+                if _pools.get((workers, start_method)) is pool:
+                    del _pools[(workers, start_method)]
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+
+        scores = np.ndarray(output['shape'], dtype='float64', buffer=out_block.buf)
+        for param, row in output['rows'].items():
+            results[param] = scores[row].copy()
+        del scores
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return results, stats
+
+def apply_rules_vectorized(df, df_rules, unique_params, plan=None, numeric_modes=None,
+                           workers=1, partition="params", start_method=None, min_parallel_rows=None):
+    """
+    Optimized function to apply rules using vectorized operations.
+    Each parameter column is coerced once and all of its rules are resolved in a single pass.
+    With workers > 1 and at least min_parallel_rows rows the parameters
+    (partition="params") or row shards (partition="rows") are scored on a
+    process pool; the result is identical.
+    """
+    if plan is None:
+        plan = compile_rules(df_rules, unique_params)
+
+    # Initialize score columns
+    for param in unique_params:
+        if param in df.columns:
+            df[f"{param} Score"] = 0.0
+
+    params = [param for param in unique_params if param in df.columns]
+    detail = _metrics['enabled']
+    if min_parallel_rows is None:
+        min_parallel_rows = ENGINE_DEFAULTS['min_parallel_rows']
+    if workers > 1 and len(df) >= max(int(min_parallel_rows), 1) and params:
+        numeric_modes = {**equality_modes(df, {p: plan.get(p, []) for p in params}), **(numeric_modes or {})}
+        results, stats = _score_params_parallel(df, plan, params, numeric_modes, workers, partition,
+                                                start_method or ENGINE_DEFAULTS['start_method'], detail)
+        for param in params:
+            df[f"{param} Score"] = results[param]
+        for param, (seconds, matched) in stats.items():
+            record_rule_stats(param, seconds, plan.get(param, []), matched, len(df))
+    else:
+        for param in params:
+            began = time.perf_counter()
+            rules = plan.get(param, [])
+            ops = {op for op, _, _ in rules}
+            prepared = prepare_column(df[param], ops, (numeric_modes or {}).get(param))
+            df[f"{param} Score"] = score_column(prepared, rules)
+            if detail:
+                # Timed before counting so the match counts don't inflate the rule time
+                seconds = time.perf_counter() - began
+                record_rule_stats(param, seconds, rules, rule_match_counts(prepared, rules), len(df))
+
+    # Sum total scores
+    score_cols = [c for c in df.columns if c.endswith(" Score")]
+    df["Total Score"] = df[score_cols].sum(axis=1)
+    return df
+
+def score_workbook(df_rules, df_data, df_grades, numeric_modes=None, execution=None):
+    """
+    Scores Sheet2 against Sheet1 and grades the totals with Sheet3.
+    execution holds the workers/partition/start_method/min_parallel_rows options of apply_rules_vectorized.
+    """
+    unique_params = df_rules['Column Name'].unique()
+
+    # USE OPTIMIZED VECTORIZED FUNCTION
+    with stage_timer("score", rows=len(df_data)):
+        df_data = apply_rules_vectorized(df_data, df_rules, unique_params, numeric_modes=numeric_modes,
+                                         **(execution or {}))
+
+    # Apply Grades
+    with stage_timer("grade", rows=len(df_data)):
+        df_data["Final Grade"] = assign_grades(df_data["Total Score"], compile_grades(df_grades))
+    return df_data
+
+def score_bounds(plan, columns):
+    """
+    Lowest and highest Total Score the rules can produce for the given columns.
+    """
+    low = high = 0.0
+    for param, rules in plan.items():
+        if param not in columns: continue
+        scores = [0.0] + [float(score) for _, _, score in rules if not pd.isna(score)]
+        low += min(scores)
+        high += max(scores)
+    return low, high
+
+def new_aggregates(low, high, bins=50):
+    if high <= low:
+        low, high = low - 0.5, high + 0.5
+    return {
+        'rows': 0,
+        'scored': 0,
+        'score_sum': 0.0,
+        'score_min': None,
+        'score_max': None,
+        'grade_counts': {},
+        'hist_edges': np.linspace(low, high, bins + 1).tolist(),
+        'hist_counts': [0] * bins,
+    }
+
+def update_aggregates(agg, scores, grades):
+    """
+    Folds one batch of Total Scores and Final Grades into the running aggregates.
+    Scores outside the histogram range are counted in the outermost bins.
+    """
+    values = pd.Series(scores).to_numpy(dtype='float64', na_value=np.nan)
+    valid = values[~np.isnan(values)]
+    agg['rows'] += len(values)
+    agg['scored'] += len(valid)
+    if len(valid):
+        agg['score_sum'] += float(valid.sum())
+        agg['score_min'] = float(valid.min()) if agg['score_min'] is None else min(agg['score_min'], float(valid.min()))
+        agg['score_max'] = float(valid.max()) if agg['score_max'] is None else max(agg['score_max'], float(valid.max()))
+        edges = np.asarray(agg['hist_edges'])
+        counts, _ = np.histogram(np.clip(valid, edges[0], edges[-1]), bins=edges)
+        agg['hist_counts'] = (np.asarray(agg['hist_counts']) + counts).tolist()
+    for grade, count in pd.Series(grades).value_counts().items():
+        if count:
+            agg['grade_counts'][str(grade)] = agg['grade_counts'].get(str(grade), 0) + int(count)
+    agg['score_mean'] = agg['score_sum'] / agg['scored'] if agg['scored'] else float('nan')
+    return agg
+
+def summarize_scores(df, bins=50):
+    """
+    Aggregates of an in-memory scored frame, in the same shape the streaming pipeline produces.
+    """
+    scores = df['Total Score']
+    agg = new_aggregates(float(scores.min()) if scores.notna().any() else 0.0,
+                         float(scores.max()) if scores.notna().any() else 0.0, bins)
+    return update_aggregates(agg, scores, df['Final Grade'])
+
+def row_hashes(df):
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+def rescore_changed_rows(df_data, previous, previous_hashes, df_rules, df_grades, numeric_modes, execution=None):
+    """
+    Scores only the Sheet2 rows that are new or changed since the previous snapshot
+    and carries the scores of every other row over. Rows are matched on BranchCode
+    plus a hash of the whole row. Returns the scored frame and the number of rescored rows.
+    """
+    new_hashes = row_hashes(df_data)
+    known = pd.Index(previous_hashes)
+    first_seen = ~known.duplicated()
+    positions = pd.Index(previous_hashes[first_seen]).get_indexer(new_hashes)
+    positions = np.where(positions >= 0, np.flatnonzero(first_seen)[positions], -1)
+
+    matched = positions >= 0
+    matched[matched] = (
+        previous['BranchCode'].to_numpy()[positions[matched]] == df_data['BranchCode'].to_numpy()[matched]
+    )
+
+    changed = score_workbook(df_rules, df_data[~matched].copy(), df_grades, numeric_modes, execution)
+    derived = [c for c in changed.columns if c not in df_data.columns or c.endswith(" Score")]
+    df = df_data.copy()
+    for col in derived:
+        if col == "Final Grade": continue
+        values = np.empty(len(df), dtype=changed[col].dtype)
+        values[matched] = previous[col].to_numpy()[positions[matched]]
+        values[~matched] = changed[col].to_numpy()
+        df[col] = values
+    # Grading is one searchsorted over the column, so it is simply redone for all rows
+    df["Final Grade"] = assign_grades(df["Total Score"], compile_grades(df_grades))
+    return df[list(changed.columns)], int((~matched).sum())
+
+def _clean_columns(df):
+    df.columns = [c.strip() for c in df.columns]
+    return df
+
+# ------------------------------------------
+# What-if simulation
+# ------------------------------------------
+# Candidate rule sets are scored against one set of prepared (coerced and
+# factorized) Sheet2 columns. Each parameter's score column is memoized on its
+# rule list, so a scenario only evaluates the parameters whose rules differ
+# from ones already seen; totals are re-summed in the same column order as
+# apply_rules_vectorized, so unchanged branches show a delta of exactly zero.
+def _rules_key(rules):
+    return tuple((op, None if pd.isna(val) else val, None if pd.isna(score) else float(score))
+                 for op, val, score in rules)
+
+def new_simulation(df, df_rules, df_grades, max_mb=64):
+    """
+    Prepares a simulation context for the rule-referenced columns of df
+    (Sheet2, scored or not) with df_rules and df_grades as the baseline.
+    The context is reused by every simulate_scenarios call and keeps at most
+    max_mb of scored columns for reuse.
+    """
+    unique_params = df_rules['Column Name'].unique()
+    plan = compile_rules(df_rules, unique_params)
+    return {
+        'df': df,
+        'rows': len(df),
+        'params': [p for p in unique_params if p in df.columns],
+        'base_plan': plan,
+        'base_grades': compile_grades(df_grades),
+        'numeric_modes': equality_modes(df, plan),
+        'prepared': {},
+        'scores': OrderedDict(),
+        'scores_bytes': 0,
+        'max_bytes': float(max_mb) * 1024 * 1024,
+        'lock': threading.Lock(),
+        'baseline': None,
+    }
+
+def _prepared_column(sim, param, ops):
+    prepared = sim['prepared'].get(param)
+    if prepared is None or not ops <= prepared['ops']:
+        ops = ops | (prepared['ops'] if prepared else set())
+        values = sim['df'][param]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Compact frames store low-cardinality text as categoricals
+            values = values.astype(object)
+        prepared = dict(prepare_column(values, ops, sim['numeric_modes'].get(param)), ops=ops)
+        count("simulation_columns_prepared")
+        sim['prepared'][param] = prepared
+    return prepared
+
+def _param_scores(sim, param, rules):
+    key = (param, _rules_key(rules))
+    cached = sim['scores'].get(key)
+    if cached is not None:
+        sim['scores'].move_to_end(key)
+        count("simulation_column_reused")
+        return cached
+    scores = score_column(_prepared_column(sim, param, {op for op, _, _ in rules}), rules)
+    # A blank Sheet1 Score scores NaN, which the row sum in apply_rules_vectorized skips
+    scores = np.where(np.isnan(scores), 0.0, scores)
+    count("simulation_column_scored")
+    sim['scores'][key] = scores
+    sim['scores_bytes'] += scores.nbytes
+    # The newest column always stays, however small the budget
+    while sim['scores_bytes'] > sim['max_bytes'] and len(sim['scores']) > 1:
+        sim['scores_bytes'] -= sim['scores'].popitem(last=False)[1].nbytes
+    return scores
+
+def _simulate_plan(sim, plan):
+    """
+    Total scores under plan and the positions of the rows whose total differs
+    from the baseline (None for the baseline itself). Only those rows are
+    re-summed, in column order, so their totals match a full rescore exactly.
+    """
+    columns = [_param_scores(sim, param, plan.get(param, [])) for param in sim['params']]
+    base = sim['baseline']
+    if base is None:
+        total = np.zeros(sim['rows'])
+        for scores in columns:
+            total += scores
+        return total, columns, None
+    differs = np.zeros(sim['rows'], dtype=bool)
+    for scores, base_scores in zip(columns, base['columns']):
+        if scores is not base_scores:
+            differs |= scores != base_scores
+    rows = np.flatnonzero(differs)
+    subtotal = np.zeros(len(rows))
+    for scores in columns:
+        subtotal += scores[rows]
+    total = base['total'].copy()
+    total[rows] = subtotal
+    return total, columns, rows
+
+def _grade_codes(total, grade_plan):
+    # A blank Grade cell compiles to code -1; it is counted in the "N/A" bucket
+    # so the codes can index label arrays and feed np.bincount
+    codes = grade_plan['band_codes'][_band_index(grade_plan['edges'], total)]
+    return np.where(np.isnan(total) | (codes < 0), grade_plan['labels'].index("N/A"), codes)
+
+def _migration_frame(counts, base_labels, labels):
+    matrix = pd.DataFrame(np.asarray(counts).reshape(len(base_labels), len(labels)),
+                          index=pd.Index(base_labels, name="Baseline"), columns=pd.Index(labels, name="Scenario"))
+    return matrix.loc[matrix.sum(axis=1) > 0, matrix.sum(axis=0) > 0]
+
+def migration_matrix(base_codes, base_labels, codes, labels):
+    """
+    Branch counts by baseline grade (rows) and scenario grade (columns),
+    leaving out grades no branch has in either.
+    """
+    counts = np.bincount(base_codes * len(labels) + codes, minlength=len(base_labels) * len(labels))
+    return _migration_frame(counts, base_labels, labels)
+
+def simulate_scenarios(sim, scenarios):
+    """
+    Scores each scenario against the prepared columns. scenarios maps a name
+    to a rules frame, or to a dict with optional 'rules' and 'grades' frames
+    (missing ones default to the baseline). Returns {name: result} where a
+    result holds the scenario's 'total' scores and 'grades', the per-branch
+    'delta' against the baseline, the grade 'migration' matrix, the number of
+    branches whose grade 'moved' and the 'changed_params'.
+    """
+    with sim['lock'], stage_timer("simulate", scenarios=len(scenarios), rows=sim['rows']):
+        base_labels = sim['base_grades']['labels']
+        if sim['baseline'] is None:
+            total, columns, _ = _simulate_plan(sim, sim['base_plan'])
+            codes = _grade_codes(total, sim['base_grades'])
+            counts = np.bincount(codes * (len(base_labels) + 1), minlength=len(base_labels) ** 2)
+            sim['baseline'] = {'total': total, 'columns': columns, 'codes': codes, 'counts': counts}
+        base = sim['baseline']
+
+        results = {}
+        for name, scenario in scenarios.items():
+            if isinstance(scenario, pd.DataFrame):
+                scenario = {'rules': scenario}
+            rules = scenario.get('rules')
+            plan = sim['base_plan'] if rules is None else compile_rules(rules, rules['Column Name'].unique())
+            grades = scenario.get('grades')
+            grade_plan = sim['base_grades'] if grades is None else compile_grades(grades)
+            labels = grade_plan['labels']
+            total, _, rows = _simulate_plan(sim, plan)
+
+            if grades is None:
+                # Same grade bands: only the rows whose total moved can change grade
+                codes = base['codes'].copy()
+                codes[rows] = _grade_codes(total[rows], grade_plan)
+                old, new = base['codes'][rows], codes[rows]
+                size = len(labels) ** 2
+                counts = (base['counts'] + np.bincount(old * len(labels) + new, minlength=size)
+                          - np.bincount(old * (len(labels) + 1), minlength=size))
+                migration = _migration_frame(counts, base_labels, labels)
+                moved = int(np.count_nonzero(old != new))
+            else:
+                codes = _grade_codes(total, grade_plan)
+                migration = migration_matrix(base['codes'], base_labels, codes, labels)
+                moved = int(np.count_nonzero(np.asarray(base_labels, dtype=object)[base['codes']]
+                                             != np.asarray(labels, dtype=object)[codes]))
+            results[name] = {
+                'total': total,
+                'grades': pd.Categorical.from_codes(codes, categories=pd.Index(labels)),
+                'delta': total - base['total'],
+                'migration': migration,
+                'moved': moved,
+                'changed_params': [p for p in sim['params']
+                                   if _rules_key(plan.get(p, [])) != _rules_key(sim['base_plan'].get(p, []))],
+            }
+        count("scenarios_simulated", len(scenarios))
+    return results
+
+def scenario_deltas(sim, result, id_col="BranchCode"):
+    """
+    Per-branch baseline and scenario score and grade for the branches a
+    scenario changes, largest absolute score change first.
+    """
+    base = sim['baseline']
+    changed = np.flatnonzero((result['delta'] != 0)
+                             | (np.asarray(sim['base_grades']['labels'], dtype=object)[base['codes']]
+                                != np.asarray(result['grades'], dtype=object)))
+    changed = changed[np.argsort(-np.abs(result['delta'][changed]), kind='stable')]
+    deltas = pd.DataFrame({
+        'Baseline Score': base['total'][changed],
+        'Scenario Score': result['total'][changed],
+        'Delta': result['delta'][changed],
+        'Baseline Grade': np.asarray(sim['base_grades']['labels'], dtype=object)[base['codes'][changed]],
+        'Scenario Grade': np.asarray(result['grades'], dtype=object)[changed],
+    })
+    if id_col in sim['df'].columns:
+        deltas.insert(0, id_col, sim['df'][id_col].to_numpy()[changed])
+    return deltas
+
+def shift_rule_value(df_rules, param, old_value, new_value):
+    """
+    Copy of a rules frame with param's rule values equal to old_value replaced,
+    e.g. moving an NPL% band edge from 0.05 to 0.04.
+    """
+    df_rules = df_rules.copy()
+    target = (df_rules['Column Name'] == param) & (df_rules['Value'] == old_value)
+    df_rules['Value'] = df_rules['Value'].astype(object)
+    df_rules.loc[target, 'Value'] = new_value
+    return df_rules
+
+# ==========================================
+# 3. DATA SOURCES
+# ==========================================
+# A source is either an Excel workbook (rules, data and grades in Sheet1/2/3)
+# or a .zip bundle holding rules, data and grades files as Parquet, Feather or
+# CSV. The format is detected from the file name or content unless the [data]
+# secrets section sets one explicitly.
+SHEET_NAMES = {'rules': "Sheet1", 'data': "Sheet2", 'grades': "Sheet3"}
+EXCEL_EXTENSIONS = (".xlsx", ".xlsm", ".xlsb", ".xls", ".ods")
+BUNDLE_EXTENSIONS = (".parquet", ".feather", ".csv")
+LOADER_DEFAULTS = {
+    'format': "auto",
+    'excel_engine': "auto",
+    'columns': "all",
+}
+
+def _source_stamp(source):
+    # Bundle directories change when any member file does, which the directory mtime does not show
+    entries = sorted(os.scandir(source), key=lambda e: e.name)
+    return ";".join(f"{e.name}:{e.stat().st_mtime_ns}:{e.stat().st_size}" for e in entries if e.is_file())
+
+def fetch_workbook(source, validators=None):
+    """
+    Fetches the workbook, sending the stored validators so an unchanged source
+    costs a single conditional request. Returns (content, validators) where
+    content is None if the source has not changed. Bundle directories are
+    read in place: their content is the directory path itself.
+    """
+    validators = validators or {}
+    if os.path.isdir(source):
+        stamp = _source_stamp(source)
+        if validators.get('stamp') == stamp:
+            return None, validators
+        return source, {'stamp': stamp}
+    if str(source).startswith(("http://", "https://")):
+        import urllib.error
+        import urllib.request
+        request = urllib.request.Request(source)
+        if validators.get('etag'):
+            request.add_header("If-None-Match", validators['etag'])
+        if validators.get('last_modified'):
+            request.add_header("If-Modified-Since", validators['last_modified'])
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                content = response.read()
+                return content, {
+                    'etag': response.headers.get("ETag"),
+                    'last_modified': response.headers.get("Last-Modified"),
+                }
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None, validators
+            raise
+
+    stat = os.stat(source)
+    stamp = f"{stat.st_mtime_ns}-{stat.st_size}"
+    if validators.get('stamp') == stamp:
+        return None, validators
+    with open(source, "rb") as f:
+        return f.read(), {'stamp': stamp}
+
+def content_digest(content):
+    """
+    SHA-256 of fetched content: the bytes, or every member file of a bundle directory.
+    """
+    digest = hashlib.sha256()
+    if isinstance(content, bytes):
+        digest.update(content)
+        return digest.hexdigest()
+    for entry in sorted(os.scandir(content), key=lambda e: e.name):
+        if entry.is_file():
+            digest.update(f"{entry.name}:{entry.stat().st_size}:".encode())
+            with open(entry.path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+def source_modified(source, validators=None):
+    """
+    When the source itself last changed, in epoch seconds: its Last-Modified
+    header for URLs, the file mtime from the fetch stamp or the newest member
+    file of a bundle directory. None if the source does not say.
+    """
+    validators = validators or {}
+    if validators.get('last_modified'):
+        try:
+            return email.utils.parsedate_to_datetime(validators['last_modified']).timestamp()
+        except (TypeError, ValueError):
+            return None
+    if str(source).startswith(("http://", "https://")):
+        return None
+    try:
+        return int(validators['stamp'].split("-")[0]) / 1e9
+    except (KeyError, ValueError):
+        pass
+    try:
+        if os.path.isdir(source):
+            return max((e.stat().st_mtime for e in os.scandir(source) if e.is_file()), default=None)
+        return os.stat(source).st_mtime
+    except OSError:
+        return None
+
+def detect_format(source, content, settings):
+    """
+    Returns "excel" or "bundle". content is the fetched bytes or a local path.
+    """
+    if settings['format'] != "auto":
+        return settings['format']
+    path = urllib.parse.urlparse(str(source)).path.lower()
+    if path.endswith(EXCEL_EXTENSIONS):
+        return "excel"
+    if path.endswith(".zip") or (not isinstance(content, bytes) and os.path.isdir(content)):
+        return "bundle"
+    archive = io.BytesIO(content) if isinstance(content, bytes) else content
+    if zipfile.is_zipfile(archive):
+        # .xlsx files are zip archives too; only a real workbook has an xl/ folder
+        with zipfile.ZipFile(archive) as z:
+            if not any(name.startswith("xl/") for name in z.namelist()):
+                return "bundle"
+    return "excel"
+
+def excel_engine(settings):
+    if settings['excel_engine'] != "auto":
+        return settings['excel_engine']
+    return "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+
+def _apply_dtypes(df, dtype):
+    for col, t in (dtype or {}).items():
+        if col in df.columns and df[col].dtype != t:
+            df[col] = df[col].astype(t)
+    return df
+
+def _rebatch(record_batches, batch_rows):
+    # Groups Arrow record batches into pandas frames of roughly batch_rows rows
+    import pyarrow as pa
+    pending, rows = [], 0
+    for batch in record_batches:
+        pending.append(batch)
+        rows += batch.num_rows
+        if rows >= batch_rows:
+            yield pa.Table.from_batches(pending).to_pandas()
+            pending, rows = [], 0
+    if pending:
+        yield pa.Table.from_batches(pending).to_pandas()
+
+def _excel_reader(content, settings):
+    xls = pd.ExcelFile(io.BytesIO(content) if isinstance(content, bytes) else content,
+                       engine=excel_engine(settings))
+
+    def header(name):
+        return list(pd.read_excel(xls, SHEET_NAMES[name], nrows=0).columns)
+
+    def read(name, usecols, dtype):
+        return pd.read_excel(xls, SHEET_NAMES[name], usecols=usecols, dtype=dtype)
+
+    def batches(name, usecols, dtype, batch_rows):
+        # Workbooks cannot be read partially, so the sheet is loaded once and sliced
+        df = read(name, usecols, dtype)
+        for start in range(0, max(len(df), 1), batch_rows):
+            yield df.iloc[start:start + batch_rows].copy()
+    return {'header': header, 'read': read, 'batches': batches}
+
+def _bundle_members(content):
+    # Maps table name -> (opener, extension) for a zip archive (bytes or path) or a directory
+    members = {}
+    if not isinstance(content, bytes) and os.path.isdir(content):
+        for name in os.listdir(content):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in BUNDLE_EXTENSIONS:
+                path = os.path.join(content, name)
+                members[stem.strip().lower()] = (lambda path=path: open(path, "rb"), ext.lower())
+        return members
+    archive = zipfile.ZipFile(io.BytesIO(content) if isinstance(content, bytes) else content)
+    for member in archive.namelist():
+        stem, ext = os.path.splitext(os.path.basename(member))
+        if ext.lower() in BUNDLE_EXTENSIONS:
+            members[stem.strip().lower()] = (lambda member=member: archive.open(member), ext.lower())
+    return members
+
+def _bundle_reader(content):
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+    members = _bundle_members(content)
+
+    def open_member(name):
+        if name not in members:
+            raise ValueError(f"Bundle has no '{name}' table (expected {name}.parquet, .feather or .csv)")
+        opener, ext = members[name]
+        return opener(), ext
+
+    def csv_options(usecols, dtype):
+        types = {c: pa.string() if t is str else pa.from_numpy_dtype(np.dtype(t)) for c, t in (dtype or {}).items()}
+        return pa_csv.ConvertOptions(include_columns=usecols or [], column_types=types)
+
+    def header(name):
+        f, ext = open_member(name)
+        with f:
+            if ext == ".csv":
+                return pa_csv.open_csv(f).schema.names
+            if ext == ".parquet":
+                return pq.read_schema(f).names
+            return pa.ipc.open_file(f).schema.names
+
+    def read(name, usecols, dtype):
+        f, ext = open_member(name)
+        with f:
+            if ext == ".csv":
+                return pa_csv.read_csv(f, convert_options=csv_options(usecols, dtype)).to_pandas()
+            if ext == ".parquet":
+                df = pd.read_parquet(f, columns=usecols)
+            else:
+                df = pd.read_feather(f, columns=usecols)
+        return _apply_dtypes(df, dtype)
+
+    def batches(name, usecols, dtype, batch_rows):
+        f, ext = open_member(name)
+        with f:
+            if ext == ".csv":
+                record_batches = pa_csv.open_csv(f, convert_options=csv_options(usecols, dtype))
+            elif ext == ".parquet":
+                record_batches = pq.ParquetFile(f).iter_batches(batch_size=batch_rows, columns=usecols)
+            else:
+                ipc = pa.ipc.open_file(f)
+                record_batches = (ipc.get_batch(i).select(usecols) if usecols else ipc.get_batch(i)
+                                  for i in range(ipc.num_record_batches))
+            for df in _rebatch(record_batches, batch_rows):
+                yield _apply_dtypes(df, dtype)
+    return {'header': header, 'read': read, 'batches': batches}
+
+def open_source(content, source, settings):
+    """
+    Returns the loader for the source's format. content is the fetched bytes,
+    or a local path for sources that are read in place.
+    """
+    if detect_format(source, content, settings) == "bundle":
+        return _bundle_reader(content)
+    return _excel_reader(content, settings)
+
+def _resolve_columns(raw, wanted, dtype):
+    # Maps stripped column names to the raw header names the engines expect
+    usecols = None if wanted is None else [c for c in raw if str(c).strip() in wanted]
+    raw_dtype = {c: dtype[str(c).strip()] for c in raw if dtype and str(c).strip() in dtype}
+    return usecols, raw_dtype or None
+
+def read_table(reader, name, wanted=None, dtype=None):
+    """
+    Reads one table, limited to the wanted (stripped) column names and with the
+    declared dtypes applied up front. Falls back to engine inference if a
+    declared numeric column turns out to hold text.
+    """
+    usecols, raw_dtype = _resolve_columns(reader['header'](name), wanted, dtype)
+    try:
+        df = reader['read'](name, usecols, raw_dtype)
+    except (ValueError, TypeError):
+        text_only = {c: t for c, t in (raw_dtype or {}).items() if t is str}
+        df = reader['read'](name, usecols, text_only or None)
+    return _clean_columns(df)
+
+def iter_table_batches(reader, name, batch_rows, wanted=None, dtype=None):
+    usecols, raw_dtype = _resolve_columns(reader['header'](name), wanted, dtype)
+    for df in reader['batches'](name, usecols, raw_dtype, batch_rows):
+        yield _clean_columns(df)
+
+def rule_column_dtypes(df_rules):
+    """
+    BranchCode is text; columns whose rules are all numeric comparisons are float64,
+    so the to_numeric coercion in prepare_column has nothing left to do.
+    """
+    dtypes = {'BranchCode': str}
+    plan = compile_rules(df_rules, df_rules['Column Name'].unique())
+    for param, rules in plan.items():
+        ops = {op for op, _, _ in rules}
+        if param != 'BranchCode' and ops - set(MATCH_ALL_OPS) and ops <= set(NUMERIC_OPS) | set(MATCH_ALL_OPS):
+            dtypes[str(param)] = "float64"
+    return dtypes
+
+def data_columns(df_rules, settings):
+    """
+    Sheet2 columns to load: everything, or BranchCode plus the rule-referenced
+    columns (and any extra columns listed in the setting).
+    """
+    columns = settings['columns']
+    if columns == "all":
+        return None
+    wanted = {'BranchCode'} | {str(p) for p in df_rules['Column Name'].dropna().unique()}
+    if columns != "rules":
+        wanted |= {str(c).strip() for c in columns}
+    return wanted
+
+def read_rule_tables(reader):
+    return read_table(reader, 'rules'), read_table(reader, 'grades')
+
+def read_branch_data(reader, df_rules, settings):
+    return read_table(reader, 'data', data_columns(df_rules, settings), rule_column_dtypes(df_rules))
+
+# ==========================================
+# 4. STREAMING PIPELINE
+# ==========================================
+def _equality_modes_streamed(reader, plan, columns, batch_rows):
+    # "=" rules compare numerically only if the whole column is numeric, so
+    # those columns are scanned once before any batch is scored.
+    params = [p for p, rules in plan.items() if p in columns and any(op == "=" for op, _, _ in rules)]
+    modes = {p: True for p in params}
+    if params:
+        for batch in iter_table_batches(reader, 'data', batch_rows, set(params)):
+            for param, is_numeric in equality_modes(batch, {p: plan[p] for p in params}).items():
+                modes[param] = modes[param] and is_numeric
+    return modes
+
+def stream_score_to_parquet(path, out_dir, loader_settings=None, batch_rows=100_000, bins=50, execution=None):
+    """
+    Scores a local workbook, .zip bundle or bundle directory in row batches and
+    writes each scored batch to a Parquet dataset in out_dir, so only one batch
+    is ever held in memory. Returns the running aggregates (row and grade counts,
+    score mean/min/max and a histogram), also saved as _aggregates.json, a name
+    Parquet dataset readers skip.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    loader_settings = dict(LOADER_DEFAULTS, **(loader_settings or {}))
+    reader = open_source(path, path, loader_settings)
+    df_rules, df_grades = read_rule_tables(reader)
+    unique_params = df_rules['Column Name'].unique()
+    plan = compile_rules(df_rules, unique_params)
+    grade_plan = compile_grades(df_grades)
+
+    wanted = data_columns(df_rules, loader_settings)
+    columns = [str(c).strip() for c in reader['header']('data')]
+    columns = [c for c in columns if wanted is None or c in wanted]
+    modes = _equality_modes_streamed(reader, plan, columns, batch_rows)
+    agg = new_aggregates(*score_bounds(plan, columns), bins=bins)
+
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(out_dir):
+        if name.startswith("part-") and name.endswith(".parquet"):
+            os.remove(os.path.join(out_dir, name))
+
+    schema = None
+    batches = iter_table_batches(reader, 'data', batch_rows, wanted, {'BranchCode': str})
+    for i, batch in enumerate(batches):
+        batch = apply_rules_vectorized(batch, df_rules, unique_params, plan, modes, **(execution or {}))
+        grades = assign_grades(batch["Total Score"], grade_plan)
+        batch["Final Grade"] = grades.cat.set_categories(grade_plan['labels'])
+        update_aggregates(agg, batch["Total Score"], batch["Final Grade"])
+
+        table = pa.Table.from_pandas(batch, schema=schema, preserve_index=False)
+        schema = table.schema
+        pq.write_table(table, os.path.join(out_dir, f"part-{i:05d}.parquet"))
+
+    with open(os.path.join(out_dir, "_aggregates.json"), "w") as f:
+        json.dump(agg, f)
+    return agg
+
+# ==========================================
+# 5. SCORED DATASET CACHE
+# ==========================================
+# Scored frames are stored on local disk keyed on the workbook content and the
+# rule/grade sheets, so restarts and redeploys start warm and a changed workbook
+# at the same URL is always picked up.
+CACHE_FORMAT_VERSION = "1"
+CACHE_DEFAULTS = {
+    'enabled': True,
+    'dir': ".risk_cache",
+    'max_mb': 1024,
+    'ttl_hours': 168,
+    'refresh_seconds': 300,
+    'incremental': True,
+    'compact': False,
+    'view_entries': 128,
+    'background_refresh': True,
+}
+_cache_lock = threading.Lock()
+
+@contextlib.contextmanager
+def _index_lock(cache_dir):
+    """
+    Serializes index.json (or history manifest.json) updates between threads
+    and between the worker processes of a --jobs run that share one directory.
+    """
+    with _cache_lock:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, "index.lock"), "a+b") as f:
+            if os.name == "nt":
+                import msvcrt
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if os.name == "nt":
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _replace_atomically(path, write):
+    # A unique temp name per writer, so concurrent writers never share a half-written file
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", suffix=".tmp", delete=False) as f:
+        tmp = f.name
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def frame_digest(df):
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(c) for c in df.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def dataset_key(content_digest, rules_digest, grades_digest, loader_settings):
+    loader = json.dumps(loader_settings, sort_keys=True, default=str)
+    parts = [CACHE_FORMAT_VERSION, content_digest, rules_digest, grades_digest, loader]
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:32]
+
+def _load_cache_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, "index.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'entries': {}, 'sources': {}}
+
+def _save_cache_index(cache_dir, index):
+    def write(tmp):
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+    _replace_atomically(os.path.join(cache_dir, "index.json"), write)
+
+def _drop_entry(cache_dir, index, key):
+    entry = index['entries'].pop(key, None)
+    if entry:
+        for name in (entry['file'], entry.get('rows'), entry.get('tables')):
+            try:
+                if name: os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+    for source in [s for s, meta in index['sources'].items() if meta.get('key') == key]:
+        del index['sources'][source]
+
+def prune_cache(cache_dir, index, max_bytes, ttl_seconds):
+    """
+    Evicts entries older than the TTL, then least recently used entries until
+    the cache fits in max_bytes.
+    """
+    now = time.time()
+    for key, entry in list(index['entries'].items()):
+        if now - entry['created'] > ttl_seconds:
+            _drop_entry(cache_dir, index, key)
+
+    by_last_use = sorted(index['entries'].items(), key=lambda item: item[1]['last_used'])
+    total = sum(entry['bytes'] for _, entry in by_last_use)
+    for key, entry in by_last_use:
+        if total <= max_bytes: break
+        _drop_entry(cache_dir, index, key)
+        total -= entry['bytes']
+
+def read_cached_frame(cache_dir, index, key):
+    entry = index['entries'].get(key)
+    if not entry: return None
+    path = os.path.join(cache_dir, entry['file'])
+    try:
+        if path.endswith(".parquet"):
+            df = pd.read_parquet(path, memory_map=True)
+        else:
+            df = pd.read_pickle(path)
+    except Exception:
+        _drop_entry(cache_dir, index, key)
+        return None
+    entry['last_used'] = time.time()
+    return df
+
+def read_cached_row_hashes(cache_dir, index, key):
+    entry = index['entries'].get(key) or {}
+    try:
+        return np.load(os.path.join(cache_dir, entry['rows']))
+    except (KeyError, TypeError, OSError, ValueError):
+        return None
+
+def read_cached_rule_tables(cache_dir, index, key):
+    entry = index['entries'].get(key) or {}
+    try:
+        return pd.read_pickle(os.path.join(cache_dir, entry['tables']))
+    except Exception:
+        return None
+
+def write_cached_rule_tables(cache_dir, index, key, df_rules, df_grades):
+    # Sheet1 and Sheet3 as parsed, so an unchanged source never has to be re-read for them
+    entry = index['entries'][key]
+    entry['tables'] = f"{key}.tables.pkl"
+    path = os.path.join(cache_dir, entry['tables'])
+    _replace_atomically(path, lambda tmp: pd.to_pickle((df_rules, df_grades), tmp))
+    entry['bytes'] += os.path.getsize(path)
+
+def write_cached_frame(cache_dir, index, key, df, hashes=None, meta=None):
+    path = os.path.join(cache_dir, f"{key}.parquet")
+    try:
+        _replace_atomically(path, df.to_parquet)
+    except Exception:
+        # Mixed-type object columns cannot always be represented in Arrow
+        path = os.path.join(cache_dir, f"{key}.pkl")
+        _replace_atomically(path, lambda tmp: df.to_pickle(tmp, compression=None))
+    size = os.path.getsize(path)
+    rows = None
+    if hashes is not None:
+        rows = f"{key}.rows.npy"
+        def write_rows(tmp):
+            with open(tmp, "wb") as f:
+                np.save(f, hashes)
+        _replace_atomically(os.path.join(cache_dir, rows), write_rows)
+        size += os.path.getsize(os.path.join(cache_dir, rows))
+    now = time.time()
+    index['entries'][key] = dict(meta or {}, **{
+        'file': os.path.basename(path),
+        'rows': rows,
+        'bytes': size,
+        'created': now,
+        'last_used': now,
+    })
+
+def invalidate_cache(cache_dir, source=None):
+    """
+    Drops the cached dataset for one source (or everything) so the next load rescores.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    with _index_lock(cache_dir):
+        index = _load_cache_index(cache_dir)
+        if source is None:
+            keys = list(index['entries'])
+        else:
+            keys = [index['sources'].get(source, {}).get('key')]
+        for key in keys:
+            _drop_entry(cache_dir, index, key)
+        index['sources'].pop(source, None)
+        _save_cache_index(cache_dir, index)
+
+def _rescore_from_snapshot(cache_dir, previous_key, previous_entry, meta, df_data, df_rules, df_grades,
+                           settings, execution):
+    # Incremental mode only applies when the rules, grades, Sheet2 layout and the
+    # "=" comparison modes all match the previous snapshot; otherwise rescore fully.
+    if not settings['incremental'] or not previous_entry or 'BranchCode' not in df_data.columns:
+        return None
+    if any(previous_entry.get(k) != meta[k] for k in ('rules_digest', 'grades_digest', 'columns', 'numeric_modes')):
+        return None
+    with _index_lock(cache_dir):
+        index = _load_cache_index(cache_dir)
+        previous = read_cached_frame(cache_dir, index, previous_key)
+        previous_hashes = read_cached_row_hashes(cache_dir, index, previous_key)
+    if previous is None or previous_hashes is None or len(previous_hashes) != len(previous):
+        return None
+    df, rescored = rescore_changed_rows(df_data, previous, previous_hashes, df_rules, df_grades,
+                                        meta['numeric_modes'], execution)
+    count("incremental_rescore")
+    count("rows_rescored", rescored)
+    return df
+
+def _downcast_scores(values):
+    # Smallest of int8/int16/int32/float32 that holds every value exactly, else unchanged
+    arr = values.to_numpy()
+    if not len(arr):
+        return values
+    if np.isfinite(arr).all() and np.array_equal(arr, np.round(arr)):
+        low, high = arr.min(), arr.max()
+        for dtype in (np.int8, np.int16, np.int32):
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return values.astype(dtype)
+    if np.array_equal(arr.astype(np.float32).astype(arr.dtype), arr, equal_nan=True):
+        return values.astype(np.float32)
+    return values
+
+def compact_frame(df, max_category_ratio=0.5):
+    """
+    Lower-memory copy of a scored frame. Score columns are downcast to
+    int8/int16/int32 or float32 where every value survives the cast. Text
+    columns with few distinct values become categoricals and the rest Arrow
+    strings. Values are unchanged; the sizes before and after are recorded as gauges.
+    """
+    arrow = importlib.util.find_spec("pyarrow") is not None
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        dtype = values.dtype
+        if str(col).endswith(" Score") and isinstance(dtype, np.dtype) and dtype.kind == "f":
+            values = _downcast_scores(values)
+        elif (dtype == object or pd.api.types.is_string_dtype(dtype)) and not isinstance(dtype, pd.CategoricalDtype):
+            if values.nunique(dropna=False) <= max(1, max_category_ratio * len(values)):
+                values = values.astype("category")
+            elif arrow and dtype == object and pd.api.types.infer_dtype(values, skipna=True) == "string":
+                values = values.astype("string[pyarrow]")
+        columns[col] = values
+    compact = pd.DataFrame(columns, index=df.index)
+    if metrics_enabled():
+        before = int(df.memory_usage(deep=True).sum())
+        after = int(compact.memory_usage(deep=True).sum())
+        set_gauge("frame_bytes", before)
+        set_gauge("frame_bytes_compact", after)
+        set_gauge("frame_bytes_saved", before - after)
+    return compact
+
+def load_scored_dataset(source, settings, loader_settings=None, execution=None, prefetched=None):
+    """
+    Returns the scored frame for source, from the disk cache when the workbook,
+    rules and grades are unchanged, otherwise by scoring it and caching the result.
+    prefetched is a (content, validators) pair from fetch_workbook, if the
+    caller has already downloaded the workbook.
+    """
+    return _load_scored(source, settings, loader_settings, execution, prefetched)['df']
+
+def _load_scored(source, settings, loader_settings, execution, prefetched):
+    # Returns {'df', 'rules', 'grades', 'modified'}: the scored frame, the Sheet1 and
+    # Sheet3 it was scored with and the source's own modification time
+    loader_settings = dict(LOADER_DEFAULTS, **(loader_settings or {}))
+    if not settings['enabled']:
+        with stage_timer("fetch"):
+            content, validators = prefetched or fetch_workbook(source)
+        with stage_timer("parse"):
+            reader = open_source(content, source, loader_settings)
+            df_rules, df_grades = read_rule_tables(reader)
+            df_data = read_branch_data(reader, df_rules, loader_settings)
+        df = score_workbook(df_rules, df_data, df_grades, execution=execution)
+        return {'df': df, 'rules': df_rules, 'grades': df_grades, 'modified': source_modified(source, validators)}
+
+    cache_dir = settings['dir']
+    max_bytes = float(settings['max_mb']) * 1024 * 1024
+    ttl_seconds = float(settings['ttl_hours']) * 3600
+    os.makedirs(cache_dir, exist_ok=True)
+
+    with _index_lock(cache_dir):
+        index = _load_cache_index(cache_dir)
+        prune_cache(cache_dir, index, max_bytes, ttl_seconds)
+        _save_cache_index(cache_dir, index)
+        known = index['sources'].get(source, {})
+        validators = known.get('validators') if known.get('key') in index['entries'] else None
+
+    if prefetched:
+        content, validators = prefetched
+    else:
+        with stage_timer("fetch"):
+            content, validators = fetch_workbook(source, validators)
+    if content is None:
+        with _index_lock(cache_dir), stage_timer("cache_read"):
+            index = _load_cache_index(cache_dir)
+            df = read_cached_frame(cache_dir, index, known['key'])
+            tables = read_cached_rule_tables(cache_dir, index, known['key'])
+            _save_cache_index(cache_dir, index)
+        if df is not None and tables is not None:
+            count("cache_hit")
+            count("source_unchanged")
+            return {'df': df, 'rules': tables[0], 'grades': tables[1], 'modified': known.get('modified')}
+        with stage_timer("fetch"):
+            content, validators = fetch_workbook(source)
+
+    modified = source_modified(source, validators)
+    with stage_timer("parse"):
+        reader = open_source(content, source, loader_settings)
+        df_rules, df_grades = read_rule_tables(reader)
+    meta = {'rules_digest': frame_digest(df_rules), 'grades_digest': frame_digest(df_grades)}
+    key = dataset_key(content_digest(content), meta['rules_digest'], meta['grades_digest'],
+                      loader_settings)
+
+    with _index_lock(cache_dir), stage_timer("cache_read"):
+        index = _load_cache_index(cache_dir)
+        df = read_cached_frame(cache_dir, index, key)
+        previous_key = index['sources'].get(source, {}).get('key')
+        previous_entry = index['entries'].get(previous_key)
+    count("cache_miss" if df is None else "cache_hit")
+    hashes = None
+    if df is None:
+        with stage_timer("parse"):
+            df_data = read_branch_data(reader, df_rules, loader_settings)
+        hashes = row_hashes(df_data)
+        plan = compile_rules(df_rules, df_rules['Column Name'].unique())
+        meta['columns'] = [str(c) for c in df_data.columns]
+        meta['numeric_modes'] = equality_modes(df_data, plan)
+        df = _rescore_from_snapshot(cache_dir, previous_key, previous_entry, meta, df_data,
+                                    df_rules, df_grades, settings, execution)
+        if df is None:
+            df = score_workbook(df_rules, df_data, df_grades, execution=execution)
+
+    with _index_lock(cache_dir), stage_timer("cache_write"):
+        index = _load_cache_index(cache_dir)
+        try:
+            if key not in index['entries']:
+                write_cached_frame(cache_dir, index, key, df, hashes, meta)
+            if not index['entries'][key].get('tables'):
+                write_cached_rule_tables(cache_dir, index, key, df_rules, df_grades)
+            index['sources'][source] = {'key': key, 'validators': validators, 'modified': modified}
+            prune_cache(cache_dir, index, max_bytes, ttl_seconds)
+            _save_cache_index(cache_dir, index)
+        except OSError:
+            pass
+    return {'df': df, 'rules': df_rules, 'grades': df_grades, 'modified': modified}
+
+def load_dataset(file_path, cache_settings=None, loader_settings=None, execution=None, prefetched=None):
+    """
+    Loads and scores the workbook at file_path (a local path or URL) through the
+    disk cache. Returns a dict with the scored 'df', the Sheet1 'rules' and
+    Sheet3 'grades' it was scored with, the source's 'modified' time (see
+    source_modified) and 'error' (None, or the message if loading failed, in
+    which case the other values are None).
+    """
+    settings = dict(CACHE_DEFAULTS, **(cache_settings or {}))
+    try:
+        with stage_timer("load_dataset"):
+            dataset = _load_scored(file_path, settings, loader_settings, execution, prefetched)
+        if settings['compact']:
+            with stage_timer("compact"):
+                dataset['df'] = compact_frame(dataset['df'])
+        return dict(dataset, error=None)
+    except Exception as e:
+        count("load_errors")
+        return {'df': None, 'rules': None, 'grades': None, 'modified': None, 'error': str(e)}
+
+def process_uploaded_file(file_path, cache_settings=None, loader_settings=None, execution=None, prefetched=None):
+    """
+    Loads and scores the workbook at file_path (a local path or URL) through the
+    disk cache. Returns (df, None), or (None, error message) if it fails.
+    """
+    dataset = load_dataset(file_path, cache_settings, loader_settings, execution, prefetched)
+    return dataset['df'], dataset['error']
+
+# ==========================================
+# 6. DATASET INDEXES
+# ==========================================
+# Lookups built once per scored frame so dashboard interactions avoid scanning
+# the portfolio: a hash index on BranchCode, the sorted Total Score column, a
+# trigram index over upper-cased branch codes, and per-column value ranges and
+# category sets with per-row category codes.
+NGRAM = 3
+_NGRAM_SHIFT = 21  # bits per code point
+
+def _ngram_key(chars):
+    key = 0
+    for c in chars:
+        key = (key << _NGRAM_SHIFT) | ord(c)
+    return key
+
+def _build_ngram_index(codes):
+    # Returns (sorted trigram keys, row positions) for a fixed-width unicode array
+    width = codes.dtype.itemsize // 4
+    if width < NGRAM or not len(codes):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    chars = codes.view(np.uint32).reshape(len(codes), width).astype(np.int64)
+    lengths = np.char.str_len(codes)
+    keys, rows = [], []
+    for k in range(width - NGRAM + 1):
+        present = np.flatnonzero(lengths >= k + NGRAM)
+        gram = np.zeros(len(present), dtype=np.int64)
+        for j in range(NGRAM):
+            gram = (gram << _NGRAM_SHIFT) | chars[present, k + j]
+        keys.append(gram)
+        rows.append(present)
+    keys, rows = np.concatenate(keys), np.concatenate(rows)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], rows[order]
+
+def build_dataset_index(df):
+    """
+    Builds the lookup structures for a scored frame. The frame must not be
+    modified afterwards, since the index refers to its row positions.
+    """
+    with stage_timer("build_index", rows=len(df)):
+        # A fresh version per build, so views derived from an older frame are never served for this one
+        index = {'version': uuid.uuid4().hex, 'rows': len(df), 'columns': {}}
+        if 'BranchCode' in df.columns:
+            branch = df['BranchCode']
+            first = ~branch.duplicated().to_numpy()
+            index['branch_lookup'] = pd.Index(branch.to_numpy()[first])
+            index['branch_rows'] = np.flatnonzero(first)
+            index['branch_list'] = sorted(branch.dropna().unique())
+            upper = branch.astype(str).str.upper().where(branch.notna(), "")
+            index['branch_upper'] = np.asarray(upper.to_numpy(), dtype=str)
+            index['ngram_keys'], index['ngram_rows'] = _build_ngram_index(index['branch_upper'])
+        if 'Total Score' in df.columns:
+            scores = df['Total Score'].to_numpy(dtype='float64', na_value=np.nan)
+            index['score_order'] = np.argsort(scores, kind='stable')
+            index['sorted_scores'] = scores[index['score_order']]
+
+        for col in df.columns:
+            values = df[col]
+            if pd.api.types.is_numeric_dtype(values):
+                index['columns'][col] = {'kind': 'numeric', 'min': float(values.min()), 'max': float(values.max())}
+            else:
+                # Missing values are their own "nan" category, whatever astype(str) does with them
+                codes, categories = pd.factorize(values.astype(str).where(values.notna(), "nan"))
+                index['columns'][col] = {
+                    'kind': 'text',
+                    'categories': categories.tolist(),
+                    'lookup': {c: i for i, c in enumerate(categories)},
+                    'codes': codes.astype(np.int32),
+                }
+    return index
+
+def branch_position(index, branch_code):
+    """
+    Row position of the first row with this BranchCode, or None.
+    """
+    i = index['branch_lookup'].get_indexer([branch_code])[0]
+    return None if i < 0 else int(index['branch_rows'][i])
+
+def percentile_rank(index, score):
+    """
+    Percentage of all rows with a Total Score strictly below score.
+    """
+    if not index['rows'] or pd.isna(score):
+        return 0.0
+    return np.searchsorted(index['sorted_scores'], score, side='left') / index['rows'] * 100
+
+def branch_search_mask(index, term):
+    """
+    Boolean row mask of branch codes containing term, ignoring case. Terms of
+    NGRAM characters or more are answered from the trigram index and verified
+    on the candidates only.
+    """
+    codes = index['branch_upper']
+    term = str(term).upper()
+    mask = np.zeros(index['rows'], dtype=bool)
+    if not term:
+        mask[:] = True
+        return mask
+    if len(term) < NGRAM:
+        return np.char.find(codes, term) >= 0
+
+    keys, rows = index['ngram_keys'], index['ngram_rows']
+    postings = []
+    for k in range(len(term) - NGRAM + 1):
+        key = _ngram_key(term[k:k + NGRAM])
+        postings.append(rows[np.searchsorted(keys, key, side='left'):np.searchsorted(keys, key, side='right')])
+    postings.sort(key=len)
+    candidates = np.unique(postings[0])
+    for posting in postings[1:]:
+        if not len(candidates):
+            break
+        candidates = np.intersect1d(candidates, posting)
+    candidates = candidates[np.char.find(codes[candidates], term) >= 0]
+    mask[candidates] = True
+    return mask
+
+def category_mask(index, col, values):
+    """
+    Boolean row mask of rows whose value (as text) is one of values.
+    """
+    info = index['columns'][col]
+    ids = [info['lookup'][v] for v in values if v in info['lookup']]
+    return np.isin(info['codes'], np.asarray(ids, dtype=np.int32))
+
+def matching_categories(index, col, term):
+    """
+    Categories of col containing term, ignoring case, in order of first appearance.
+    """
+    categories = index['columns'][col]['categories']
+    hits = np.char.find(np.char.upper(np.asarray(categories, dtype=str)), str(term).upper()) >= 0
+    return [c for c, hit in zip(categories, hits) if hit]
+
+def page_rows(frame, rows, start, size, sort_by=None, ascending=True):
+    """
+    Row positions of the table page starting at start from rows (positions
+    into frame), ordered by the sort_by column if given. Only that column is
+    sorted; the caller gathers the other columns for the page alone.
+    """
+    if sort_by is None:
+        return rows[start:start + size]
+    column = frame[sort_by].iloc[rows].reset_index(drop=True)
+    try:
+        order = column.sort_values(ascending=ascending, kind="stable").index
+    except TypeError:
+        # Object columns mixing numbers and text cannot be compared directly
+        order = column.sort_values(ascending=ascending, kind="stable", key=lambda s: s.astype(str)).index
+    return rows[order[start:start + size]]
+
+# Above this many branches the score distribution is drawn from aggregates, with
+# per-branch bars only for a drilled-down slice of at most this many branches
+BAR_DETAIL_MAX = 300
+
+def _grade_codes_in_score_order(index, grade_col):
+    grade_index = index['columns'][grade_col]
+    return grade_index, grade_index['codes'][index['score_order']]
+
+def grade_histogram(index, edges, grade_col="Final Grade"):
+    """
+    Rows per Total Score bin for each grade, as {grade: counts}. Bins are
+    half-open except the last; scores outside the edges are not counted.
+    """
+    edges = np.asarray(edges, dtype='float64')
+    scores = index['sorted_scores']
+    valid = ~np.isnan(scores)
+    grade_index, grades = _grade_codes_in_score_order(index, grade_col)
+    return {grade: np.histogram(scores[valid & (grades == code)], bins=edges)[0]
+            for grade, code in grade_index['lookup'].items()}
+
+def score_range_rows(index, low, high, inclusive=False):
+    """
+    Row positions with low <= Total Score < high (<= high if inclusive), in
+    ascending score order.
+    """
+    scores = index['sorted_scores']
+    start = np.searchsorted(scores, low, side='left')
+    stop = np.searchsorted(scores, high, side='right' if inclusive else 'left')
+    return index['score_order'][start:stop]
+
+def group_grade_counts(index, col, grade_col="Final Grade"):
+    """
+    Rows per grade and mean Total Score for each category of a text column,
+    as a frame indexed by category.
+    """
+    group_index = index['columns'][col]
+    groups = group_index['codes'][index['score_order']]
+    grade_index, grades = _grade_codes_in_score_order(index, grade_col)
+    scores = index['sorted_scores']
+    n = len(group_index['categories'])
+    counts = pd.DataFrame(
+        {grade: np.bincount(groups[grades == code], minlength=n) for grade, code in grade_index['lookup'].items()},
+        index=pd.Index(group_index['categories'], name=col),
+    )
+    valid = ~np.isnan(scores)
+    scored = np.bincount(groups[valid], minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        counts['Mean Score'] = np.bincount(groups[valid], weights=scores[valid], minlength=n) / scored
+    return counts
+
+# ==========================================
+# 7. VIEW CACHE
+# ==========================================
+# Process-wide LRU of views derived from a scored dataset (aggregates, chart
+# figures), shared by every session. Keys start with the dataset index version
+# and carry whatever widget state the view depends on; cached values are
+# shared between callers and must be treated as read-only.
+_views = OrderedDict()
+_views_lock = threading.Lock()
+_view_settings = {'max_entries': CACHE_DEFAULTS['view_entries']}
+
+def configure_view_cache(max_entries):
+    with _views_lock:
+        _view_settings['max_entries'] = max(0, int(max_entries))
+        while len(_views) > _view_settings['max_entries']:
+            _views.popitem(last=False)
+
+def clear_view_cache():
+    with _views_lock:
+        _views.clear()
+    set_gauge("view_cache_entries", 0)
+
+def drop_views(version):
+    """Evicts every view derived from one dataset version."""
+    with _views_lock:
+        for key in [k for k in _views if k[0] == version]:
+            del _views[key]
+        entries = len(_views)
+    set_gauge("view_cache_entries", entries)
+
+def cached_view(key, build):
+    """
+    Returns the cached value for key, calling build() to create it on a miss
+    and evicting the least recently used entries beyond max_entries.
+    """
+    with _views_lock:
+        if key in _views:
+            _views.move_to_end(key)
+            count("view_cache_hit")
+            return _views[key]
+    count("view_cache_miss")
+    with stage_timer("build_view", view=str(key[1]) if len(key) > 1 else ""):
+        value = build()
+    with _views_lock:
+        if _view_settings['max_entries']:
+            _views[key] = value
+            _views.move_to_end(key)
+            while len(_views) > _view_settings['max_entries']:
+                _views.popitem(last=False)
+                count("view_cache_evicted")
+        entries = len(_views)
+    set_gauge("view_cache_entries", entries)
+    return value
+
+# ==========================================
+# 8. SNAPSHOT HISTORY
+# ==========================================
+# Every scored dataset can be kept as a versioned Parquet snapshot under the
+# period it was scored in (period=<label>/<version>.parquet, with a JSON
+# manifest of the versions per period). Snapshots hold BranchCode, the score
+# columns and the grade, sorted by BranchCode in small row groups, so a
+# branch's history is a row-group-statistics lookup per period and a
+# migration reads two columns of two periods, without rescoring anything.
+HISTORY_DEFAULTS = {
+    'enabled': False,
+    'dir': ".risk_history",
+    'period': "M",
+    'keep_versions': 3,
+}
+HISTORY_ROW_GROUP = 16_384
+
+def period_label(timestamp=None, freq="M"):
+    """Period label (e.g. 2026-10 for freq M, 2026Q4 for Q) of a Unix timestamp, in local time."""
+    return str(pd.Timestamp.fromtimestamp(time.time() if timestamp is None else timestamp).to_period(freq))
+
+def _load_history_manifest(store_dir):
+    try:
+        with open(os.path.join(store_dir, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'periods': {}}
+
+def _save_history_manifest(store_dir, manifest):
+    def write(tmp):
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+    _replace_atomically(os.path.join(store_dir, "manifest.json"), write)
+
+def _history_columns(df):
+    return ['BranchCode'] + [c for c in df.columns if c.endswith(" Score") or c == "Final Grade"]
+
+def save_snapshot(store_dir, df, period, source=None, keep_versions=3):
+    """
+    Stores a scored frame as the current version for period, unless it is
+    identical to the period's current version. Older versions beyond
+    keep_versions are deleted. Returns the manifest entry of the version.
+    """
+    frame = df[_history_columns(df)].sort_values('BranchCode', kind='stable', ignore_index=True)
+    # Missing grades stay missing rather than becoming the string "nan"
+    frame['Final Grade'] = frame['Final Grade'].astype('string').astype('category')
+    digest = frame_digest(frame)
+    # The manifest is shared by every thread and --jobs process writing to the store
+    with _index_lock(store_dir):
+        manifest = _load_history_manifest(store_dir)
+        versions = manifest['periods'].get(period, {}).get('versions', [])
+        if versions and versions[-1]['digest'] == digest:
+            count("history_unchanged")
+            return versions[-1]
+
+        version = digest[:16]
+        folder = "period=" + period.replace("/", "_")
+        os.makedirs(os.path.join(store_dir, folder), exist_ok=True)
+        file = os.path.join(folder, f"{version}.parquet")
+        path = os.path.join(store_dir, file)
+        _replace_atomically(path, lambda tmp: frame.to_parquet(tmp, index=False, row_group_size=HISTORY_ROW_GROUP))
+
+        entry = {'version': version, 'file': file, 'rows': len(frame), 'created': time.time(),
+                 'digest': digest, 'source': source}
+        versions = [v for v in versions if v['version'] != version] + [entry]
+        for old in versions[:-max(1, int(keep_versions))]:
+            try:
+                os.remove(os.path.join(store_dir, old['file']))
+            except OSError:
+                pass
+        manifest['periods'][period] = {'versions': versions[-max(1, int(keep_versions)):]}
+        _save_history_manifest(store_dir, manifest)
+    count("history_writes")
+    return entry
+
+def history_periods(store_dir):
+    """
+    {period: current version entry}, oldest period first.
+    """
+    periods = _load_history_manifest(store_dir)['periods']
+    return {period: periods[period]['versions'][-1] for period in sorted(periods) if periods[period]['versions']}
+
+def _read_period(store_dir, entry, columns=None, filters=None):
+    import pyarrow.parquet as pq
+    return pq.read_table(os.path.join(store_dir, entry['file']), columns=columns, filters=filters).to_pandas()
+
+def branch_history(store_dir, branch_code, periods=None):
+    """
+    The branch's stored scores and grade per period, one row per period in
+    which it appears, indexed by period.
+    """
+    stored = history_periods(store_dir)
+    rows = []
+    with stage_timer("history_branch"):
+        for period in stored if periods is None else [p for p in periods if p in stored]:
+            match = _read_period(store_dir, stored[period], filters=[('BranchCode', '==', branch_code)])
+            if len(match):
+                rows.append(match.iloc[0].rename(period))
+    history = pd.DataFrame(rows)
+    history.index.name = "Period"
+    return history
+
+def period_migration(store_dir, from_period, to_period):
+    """
+    Compares the grades of two stored periods. Returns a dict with the grade
+    migration 'matrix' of branches present in both, the counts of 'new' and
+    'exited' branches, and the branches whose grade 'changes'.
+    """
+    stored = history_periods(store_dir)
+    columns = ['BranchCode', 'Total Score', 'Final Grade']
+    with stage_timer("history_migration"):
+        before = _read_period(store_dir, stored[from_period], columns).drop_duplicates('BranchCode')
+        after = _read_period(store_dir, stored[to_period], columns).drop_duplicates('BranchCode')
+        positions = pd.Index(after['BranchCode']).get_indexer(before['BranchCode'])
+        both = positions >= 0
+        new_branches, exited = len(after) - int(both.sum()), int((~both).sum())
+        before, after = before[both].reset_index(drop=True), after.iloc[positions[both]].reset_index(drop=True)
+
+        # Grades are stored dictionary-encoded, so only the category lists are compared
+        before_grades, after_grades = before['Final Grade'].astype('category'), after['Final Grade'].astype('category')
+        labels = sorted(set(before_grades.cat.categories) | set(after_grades.cat.categories) | {"N/A"})
+        # Blank grades (code -1) are counted as "N/A" so the codes can feed np.bincount
+        na = labels.index("N/A")
+        old = np.where(before_grades.isna(), na, before_grades.cat.set_categories(labels).cat.codes.to_numpy())
+        new = np.where(after_grades.isna(), na, after_grades.cat.set_categories(labels).cat.codes.to_numpy())
+        counts = np.bincount(old * len(labels) + new, minlength=len(labels) ** 2)
+        matrix = _migration_frame(counts, labels, labels)
+        matrix.index.name, matrix.columns.name = from_period, to_period
+
+        moved = np.flatnonzero(old != new)
+        changes = pd.DataFrame({
+            'BranchCode': before['BranchCode'].to_numpy()[moved],
+            f'{from_period} Score': before['Total Score'].to_numpy()[moved],
+            f'{to_period} Score': after['Total Score'].to_numpy()[moved],
+            f'{from_period} Grade': before['Final Grade'].to_numpy()[moved],
+            f'{to_period} Grade': after['Final Grade'].to_numpy()[moved],
+        })
+    return {'matrix': matrix, 'new': new_branches, 'exited': exited, 'changes': changes}
+
+# ==========================================
+# 9. BACKGROUND REFRESH
+# ==========================================
+# One worker thread per source re-checks it every interval with a conditional
+# fetch and, when it has changed, loads, scores and indexes the new version off
+# the request path. Readers always get the last good snapshot, which is swapped
+# in whole, so a frame is never seen with another version's index.
+_refreshers = {}
+_refreshers_lock = threading.Lock()
+
+def _check_source(state, force):
+    # Returns (changed, prefetched, digest) and records the new validators. Unless
+    # forced, content identical to the current snapshot's is not a change: servers
+    # without ETag or Last-Modified resend the whole file on every check
+    content, validators = fetch_workbook(state['source'], None if force else state['validators'])
+    state['validators'] = validators
+    if content is None:
+        return False, None, None
+    digest = content_digest(content)
+    return force or digest != state['digest'], (content, validators), digest
+
+def _record_history(state):
+    history, snapshot = state['history'], state['snapshot']
+    try:
+        with stage_timer("history_write"):
+            save_snapshot(history['dir'], snapshot['df'], period_label(snapshot['as_of'], history['period']),
+                          state['source'], history['keep_versions'])
+    except Exception as e:
+        # The dashboard keeps serving the new snapshot; only its history entry is missing
+        count("history_errors")
+        logger.warning("history write failed for %s: %s", state['source'], e)
+
+def refresh_dataset(state, force=False):
+    """
+    Checks the source once and, if it changed (or force is set), rebuilds
+    and swaps in a new snapshot. A failed rebuild keeps the previous good
+    snapshot and is reported in state['last_error']. Returns True on a swap.
+    """
+    with state['lock']:
+        state['checked_at'] = time.time()
+        try:
+            with stage_timer("refresh_check"):
+                changed, prefetched, digest = _check_source(state, force)
+        except Exception as e:
+            count("refresh_errors")
+            state['last_error'] = str(e)
+            return False
+        previous = state['snapshot']
+        if not changed and previous is not None and previous['error'] is None:
+            count("refresh_unchanged")
+            return False
+
+        with stage_timer("refresh"):
+            dataset = load_dataset(state['source'], *state['settings'], prefetched=prefetched)
+            df, error = dataset['df'], dataset['error']
+            if error is None:
+                try:
+                    index = build_dataset_index(df)
+                except Exception as e:
+                    df, index, error = None, None, str(e)
+        if error is not None and previous is not None and previous['error'] is None:
+            count("refresh_errors")
+            state['last_error'] = error
+            # Check again next time instead of treating the broken version as current
+            state['validators'] = {}
+            return False
+
+        state['digest'] = None if error else digest
+        state['snapshot'] = {
+            'df': df,
+            'index': None if error else index,
+            'error': error,
+            # The source's own modification time; the load time only if the source has none
+            'as_of': dataset['modified'] or time.time(),
+            'version': None if error else index['version'],
+            # Sheet1 and Sheet3 are kept as the baseline for what-if simulations
+            'rules': None if error else dataset['rules'],
+            'grades': None if error else dataset['grades'],
+        }
+        state['last_error'] = error
+        count("dataset_swaps")
+        set_gauge("dataset_as_of", state['snapshot']['as_of'])
+        if previous is not None and previous['version'] is not None:
+            drop_views(previous['version'])
+        if error is None and state['history']['enabled']:
+            _record_history(state)
+        return True
+
+def _refresh_loop(state):
+    while True:
+        state['wake'].wait(state['interval'])
+        state['wake'].clear()
+        if state['stop'].is_set():
+            return
+        refresh_dataset(state)
+
+def start_refresher(source, interval, cache_settings=None, loader_settings=None, execution=None,
+                    history_settings=None):
+    """
+    Returns the refresher state for source, loading the first snapshot in the
+    calling thread and starting the background thread if interval is positive.
+    With history enabled every new snapshot is also saved to the history store.
+    Calling it again for the same source returns the running refresher.
+    """
+    with _refreshers_lock:
+        state = _refreshers.get(source)
+        if state is None:
+            state = {
+                'source': source,
+                'settings': (cache_settings, loader_settings, execution),
+                'history': dict(HISTORY_DEFAULTS, **(history_settings or {})),
+                'interval': float(interval),
+                'snapshot': None,
+                'validators': {},
+                'digest': None,
+                'checked_at': None,
+                'last_error': None,
+                'lock': threading.Lock(),
+                'wake': threading.Event(),
+                'stop': threading.Event(),
+                'thread': None,
+            }
+            _refreshers[source] = state
+    if state['snapshot'] is None:
+        refresh_dataset(state, force=True)
+    if state['interval'] > 0 and state['thread'] is None:
+        with state['lock']:
+            if state['thread'] is None:
+                state['thread'] = threading.Thread(target=_refresh_loop, args=(state,), daemon=True,
+                                                   name=f"risk-refresh-{len(_refreshers)}")
+                state['thread'].start()
+    return state
+
+def current_snapshot(source):
+    """The last good snapshot for a started source, or None."""
+    state = _refreshers.get(source)
+    return None if state is None else state['snapshot']
+
+def stop_refresher(source):
+    with _refreshers_lock:
+        state = _refreshers.pop(source, None)
+    if state is not None:
+        state['stop'].set()
+        state['wake'].set()
+        if state['thread'] is not None:
+            state['thread'].join()
+
+# ==========================================
+# 10. COMMAND LINE
+# ==========================================
+OUTPUT_FORMATS = ("parquet", "csv")
+
+def expand_sources(paths):
+    """
+    Expands directories into the workbooks and .zip bundles they hold. A
+    directory that is itself a bundle (rules, data and grades files) stays one source.
+    """
+    sources = []
+    for path in paths:
+        if os.path.isdir(path) and not {'rules', 'data', 'grades'} <= set(_bundle_members(path)):
+            names = sorted(os.listdir(path))
+            sources.extend(os.path.join(path, n) for n in names
+                           if n.lower().endswith(EXCEL_EXTENSIONS + (".zip",)) and not n.startswith("~$"))
+        else:
+            sources.append(path)
+    return sources
+
+def score_to_file(source, out_path, fmt="parquet", cache_settings=None, loader_settings=None,
+                  execution=None, stream=False, batch_rows=100_000, history=None):
+    """
+    Scores one source and writes it to out_path. With stream=True the source is
+    scored in row batches into a Parquet dataset directory. history, a dict
+    with the store 'dir', 'period' label and 'keep_versions', also saves the
+    scored frame to the history store. Returns a summary dict with the row
+    count, elapsed seconds and error (None on success).
+    """
+    start = time.perf_counter()
+    result = {'source': source, 'output': out_path, 'rows': 0, 'error': None}
+    try:
+        if stream:
+            result['rows'] = stream_score_to_parquet(source, out_path, loader_settings, batch_rows,
+                                                     execution=execution)['rows']
+        else:
+            df, error = process_uploaded_file(source, cache_settings, loader_settings, execution)
+            if error:
+                raise RuntimeError(error)
+            if fmt == "csv":
+                df.to_csv(out_path, index=False)
+            else:
+                df.to_parquet(out_path, index=False)
+            result['rows'] = len(df)
+            if history:
+                result['history'] = save_snapshot(history['dir'], df, history['period'], source,
+                                                  history.get('keep_versions', HISTORY_DEFAULTS['keep_versions']))
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Score branch risk workbooks without the dashboard.")
+    parser.add_argument("sources", nargs="+",
+                        help="workbooks, .zip bundles, bundle directories or directories of workbooks")
+    parser.add_argument("-o", "--out-dir", default=".", help="directory for the scored files")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="parquet")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="workbooks scored in parallel")
+    parser.add_argument("--workers", type=int, default=ENGINE_DEFAULTS['workers'],
+                        help="scoring processes per workbook")
+    parser.add_argument("--partition", choices=("params", "rows"), default=ENGINE_DEFAULTS['partition'])
+    parser.add_argument("--cache-dir", help="reuse and fill the scored dataset cache in this directory")
+    parser.add_argument("--stream", action="store_true",
+                        help="score in row batches into a Parquet dataset directory per source")
+    parser.add_argument("--batch-rows", type=int, default=100_000)
+    parser.add_argument("--data-format", choices=("auto", "excel", "bundle"), default=LOADER_DEFAULTS['format'])
+    parser.add_argument("--excel-engine", default=LOADER_DEFAULTS['excel_engine'])
+    parser.add_argument("--columns", choices=("all", "rules"), default=LOADER_DEFAULTS['columns'])
+    parser.add_argument("--history", metavar="DIR", help="also save the scored dataset to this snapshot history store")
+    parser.add_argument("--period", help="history period label (default: the current month)")
+    args = parser.parse_args(argv)
+    if args.stream and args.format != "parquet":
+        parser.error("--stream writes Parquet datasets; use --format parquet")
+    if args.history and args.stream:
+        parser.error("--history needs the scored frame in memory; drop --stream")
+
+    cache_settings = {'enabled': bool(args.cache_dir), 'dir': args.cache_dir or CACHE_DEFAULTS['dir']}
+    loader_settings = {'format': args.data_format, 'excel_engine': args.excel_engine, 'columns': args.columns}
+    execution = {'workers': args.workers, 'partition': args.partition}
+
+    sources = expand_sources(args.sources)
+    if not sources:
+        parser.error("no workbooks found")
+    if args.history and len(sources) > 1:
+        parser.error("--history records one dataset per period; score one source at a time")
+    history = None
+    if args.history:
+        history = {'dir': args.history, 'period': args.period or period_label(None, HISTORY_DEFAULTS['period'])}
+    os.makedirs(args.out_dir, exist_ok=True)
+    outputs = []
+    for source in sources:
+        stem = os.path.splitext(os.path.basename(os.path.normpath(source)))[0]
+        outputs.append(os.path.join(args.out_dir, stem if args.stream else f"{stem}.{args.format}"))
+
+    start = time.perf_counter()
+    jobs = [(source, out_path, args.format, cache_settings, loader_settings, execution, args.stream,
+             args.batch_rows, history) for source, out_path in zip(sources, outputs)]
+    if args.jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(args.jobs, len(jobs)),
+                                 mp_context=multiprocessing.get_context(ENGINE_DEFAULTS['start_method'])) as pool:
+            results = list(pool.map(score_to_file, *zip(*jobs)))
+    else:
+        results = [score_to_file(*job) for job in jobs]
+
+    failed = 0
+    for result in results:
+        if result['error']:
+            failed += 1
+            print(f"FAILED  {result['source']}: {result['error']}")
+        else:
+            print(f"{result['rows']:>10,} rows  {result['seconds']:8.2f}s  {result['source']} -> {result['output']}")
+    total_rows = sum(r['rows'] for r in results)
+    print(f"{total_rows:>10,} rows  {time.perf_counter() - start:8.2f}s  total "
+          f"({len(results) - failed}/{len(results)} sources)")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
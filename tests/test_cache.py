@@ -0,0 +1,203 @@
+"""
+Checks the scored dataset cache: what is cached, when it is reused, and that
+a cached load returns the same frame as a fresh score.
+"""
+import functools
+import http.server
+import os
+import shutil
+import threading
+import warnings
+
+import pandas as pd
+import pytest
+
+import risk_engine
+from benchmark import synthetic_tables, write_source
+
+@pytest.fixture(autouse=True)
+def counters():
+    risk_engine.configure_metrics(enabled=True)
+    risk_engine.reset_metrics()
+    yield
+    risk_engine.configure_metrics(enabled=False)
+
+def counted():
+    counts = risk_engine.metrics_snapshot()['counters']
+    risk_engine.reset_metrics()
+    return counts
+
+def load(source, cache_dir, **settings):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        dataset = risk_engine.load_dataset(source, dict({'dir': str(cache_dir)}, **settings))
+    assert dataset['error'] is None, dataset['error']
+    return dataset
+
+def fresh_score(source):
+    return load(source, None, enabled=False)['df']
+
+# ==========================================
+# BUNDLE DIRECTORIES
+# ==========================================
+@pytest.fixture
+def bundle(tmp_path):
+    return write_source(synthetic_tables(200, params=4, seed=1), str(tmp_path / "bundle"), "parquet")
+
+def test_bundle_directory_is_cached(bundle, tmp_path):
+    first = load(bundle, tmp_path / "cache")
+    assert counted().get('cache_miss') == 1
+    again = load(bundle, tmp_path / "cache")
+    assert counted() == {'cache_hit': 1, 'source_unchanged': 1}
+    pd.testing.assert_frame_equal(again['df'], first['df'])
+    pd.testing.assert_frame_equal(again['rules'], first['rules'])
+    pd.testing.assert_frame_equal(first['df'], fresh_score(bundle))
+    assert first['modified'] == max(os.stat(os.path.join(bundle, n)).st_mtime for n in os.listdir(bundle))
+
+def test_edited_bundle_member_is_rescored(bundle, tmp_path):
+    load(bundle, tmp_path / "cache")
+    counted()
+    path = os.path.join(bundle, "data.parquet")
+    data = pd.read_parquet(path)
+    data.loc[0, 'P000'] = data['P000'].iloc[1]
+    data.to_parquet(path, index=False)
+    edited = load(bundle, tmp_path / "cache")
+    assert counted().get('cache_miss') == 1
+    pd.testing.assert_frame_equal(edited['df'], fresh_score(bundle))
+
+def test_refresher_serves_bundle_directory(bundle, tmp_path):
+    state = risk_engine.start_refresher(bundle, 0, {'dir': str(tmp_path / "cache")})
+    try:
+        assert state['snapshot']['error'] is None
+        assert len(state['snapshot']['df']) == 200
+        assert not risk_engine.refresh_dataset(state)
+    finally:
+        risk_engine.stop_refresher(bundle)
+
+# ==========================================
+# INCREMENTAL RESCORE
+# ==========================================
+def test_rescore_changed_rows_matches_a_full_score():
+    rules, data, grades = synthetic_tables(300, params=5, seed=3)
+    # Row 10 is in the previous snapshot twice
+    data = pd.concat([data, data.iloc[[10]]], ignore_index=True)
+    previous = risk_engine.score_workbook(rules, data.copy(), grades)
+
+    edited = data.copy()
+    edited.loc[[5, 6], 'P001'] += 1.0
+    edited.loc[300, 'P002'] += 1.0
+    edited = edited.drop(index=[20, 21])
+    inserted = data.iloc[[30, 31]].assign(BranchCode=["new1", "new2"])
+    # Inserted rows first, so every kept row moves, and a new copy of row 40 last
+    edited = pd.concat([inserted, edited, data.iloc[[40]]], ignore_index=True)
+
+    df, rescored = risk_engine.rescore_changed_rows(edited, previous, risk_engine.row_hashes(data),
+                                                    rules, grades, None)
+    assert rescored == 5
+    pd.testing.assert_frame_equal(df, risk_engine.score_workbook(rules, edited.copy(), grades))
+
+@pytest.fixture
+def tables():
+    return synthetic_tables(300, params=5, seed=3)
+
+def edit_row(data):
+    data.loc[0, 'P001'] += 1.0
+    return data
+
+def reload_edited(tables, tmp_path, edit, **settings):
+    # Loads the bundle, rewrites it with edit(rules, data, grades) and loads it again.
+    # Returns the counters of the second load, which must match a full rescore
+    path = write_source(tables, str(tmp_path / "bundle"), "parquet")
+    load(path, tmp_path / "cache", **settings)
+    counted()
+    write_source(edit(*[table.copy() for table in tables]), path, "parquet")
+    df = load(path, tmp_path / "cache", **settings)['df']
+    counts = counted()
+    pd.testing.assert_frame_equal(df, fresh_score(path))
+    return counts
+
+def test_edited_rows_are_rescored_incrementally(tables, tmp_path):
+    def edit(rules, data, grades):
+        data = edit_row(data).drop(index=[7])
+        return rules, pd.concat([data, data.iloc[[3]].assign(BranchCode="new")], ignore_index=True), grades
+    counts = reload_edited(tables, tmp_path, edit)
+    assert counts['cache_miss'] == 1
+    assert counts['incremental_rescore'] == 1 and counts['rows_rescored'] == 2
+
+FULL_RESCORE = {
+    'rules': lambda rules, data, grades: (rules.assign(Score=rules['Score'] + 1), edit_row(data), grades),
+    'grades': lambda rules, data, grades: (rules, edit_row(data),
+                                           grades.assign(**{'Min Score': grades['Min Score'] - 0.5})),
+    'layout': lambda rules, data, grades: (rules, edit_row(data)[data.columns[::-1]], grades),
+    'columns': lambda rules, data, grades: (rules, edit_row(data).assign(Notes="x"), grades),
+    # P000 has "=" rules; all-numeric text switches it to numeric comparison
+    'numeric_modes': lambda rules, data, grades: (rules, data.assign(P000=[str(i % 7) for i in range(len(data))]),
+                                                  grades),
+}
+
+@pytest.mark.parametrize("change", sorted(FULL_RESCORE))
+def test_changed_scoring_inputs_rescore_fully(tables, tmp_path, change):
+    counts = reload_edited(tables, tmp_path, FULL_RESCORE[change])
+    assert counts['cache_miss'] == 1 and 'incremental_rescore' not in counts
+
+def test_incremental_disabled_rescores_fully(tables, tmp_path):
+    counts = reload_edited(tables, tmp_path, lambda rules, data, grades: (rules, edit_row(data), grades),
+                           incremental=False)
+    assert counts['cache_miss'] == 1 and 'incremental_rescore' not in counts
+
+def test_data_without_branch_codes_rescores_fully(tables, tmp_path):
+    rules, data, grades = tables
+    counts = reload_edited((rules, data.drop(columns='BranchCode'), grades), tmp_path,
+                           lambda rules, data, grades: (rules, edit_row(data), grades))
+    assert counts['cache_miss'] == 1 and 'incremental_rescore' not in counts
+
+# ==========================================
+# BACKGROUND REFRESH
+# ==========================================
+class NoValidatorsHandler(http.server.SimpleHTTPRequestHandler):
+    # A server that sends neither ETag nor Last-Modified, so every check downloads the file
+    def send_header(self, keyword, value):
+        if keyword not in ("ETag", "Last-Modified"):
+            super().send_header(keyword, value)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def served_workbook(tmp_path):
+    (tmp_path / "site").mkdir()
+    write_source(synthetic_tables(100, params=3, seed=2), str(tmp_path / "site" / "book"), "excel")
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(NoValidatorsHandler, directory=str(tmp_path / "site")))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/book.xlsx"
+    yield url, tmp_path / "site" / "book.xlsx"
+    risk_engine.stop_refresher(url)
+    server.shutdown()
+
+def test_identical_download_keeps_the_snapshot(served_workbook, tmp_path):
+    url, path = served_workbook
+    state = risk_engine.start_refresher(url, 0, {'dir': str(tmp_path / "cache")})
+    snapshot = state['snapshot']
+    assert not risk_engine.refresh_dataset(state)
+    assert not risk_engine.refresh_dataset(state)
+    assert state['snapshot'] is snapshot
+
+    write_source(synthetic_tables(120, params=3, seed=2), str(path)[:-len(".xlsx")], "excel")
+    assert risk_engine.refresh_dataset(state)
+    assert state['snapshot']['version'] != snapshot['version']
+    assert len(state['snapshot']['df']) == 120
+
+def test_touched_bundle_keeps_the_snapshot(bundle, tmp_path):
+    state = risk_engine.start_refresher(bundle, 0, {'dir': str(tmp_path / "cache")})
+    try:
+        snapshot = state['snapshot']
+        # Same bytes under a new mtime
+        path = os.path.join(bundle, "grades.parquet")
+        shutil.copyfile(path, path + ".copy")
+        os.replace(path + ".copy", path)
+        assert not risk_engine.refresh_dataset(state)
+        assert state['snapshot'] is snapshot
+        assert risk_engine.refresh_dataset(state, force=True)
+    finally:
+        risk_engine.stop_refresher(bundle)
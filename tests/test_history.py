@@ -0,0 +1,138 @@
+"""
+Checks the snapshot history store: what save_snapshot keeps, and that
+branch_history and period_migration read back what was stored.
+"""
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import risk_engine
+
+@pytest.fixture(autouse=True)
+def counters():
+    risk_engine.configure_metrics(enabled=True)
+    risk_engine.reset_metrics()
+    yield
+    risk_engine.configure_metrics(enabled=False)
+
+def scored(codes, scores, grades):
+    # The columns of a scored frame that the store keeps, plus one it drops
+    return pd.DataFrame({
+        'BranchCode': codes,
+        'Region': "North",
+        'P0 Score': scores,
+        'Total Score': scores,
+        'Final Grade': pd.Categorical(grades),
+    })
+
+def stored_files(store):
+    return sorted(name for _, _, names in os.walk(store) for name in names if name.endswith(".parquet"))
+
+# ==========================================
+# SAVE_SNAPSHOT
+# ==========================================
+def test_snapshot_keeps_branch_scores_sorted(tmp_path):
+    df = scored(["B2", "B1", "B3"], [2.0, 1.0, 3.0], ["B", "A", "C"])
+    entry = risk_engine.save_snapshot(str(tmp_path), df, "2026-09", source="book.xlsx")
+    assert entry['rows'] == 3 and entry['source'] == "book.xlsx"
+    stored = pd.read_parquet(tmp_path / entry['file'])
+    assert list(stored.columns) == ['BranchCode', 'P0 Score', 'Total Score', 'Final Grade']
+    assert stored['BranchCode'].tolist() == ["B1", "B2", "B3"]
+    assert stored['Final Grade'].tolist() == ["A", "B", "C"]
+    assert risk_engine.history_periods(str(tmp_path)) == {"2026-09": entry}
+
+def test_unchanged_snapshot_is_not_written_again(tmp_path):
+    df = scored(["B1", "B2"], [1.0, 2.0], ["A", "B"])
+    first = risk_engine.save_snapshot(str(tmp_path), df, "2026-09")
+    # Row order does not matter, the store sorts by BranchCode
+    again = risk_engine.save_snapshot(str(tmp_path), df.iloc[::-1], "2026-09")
+    assert again == first
+    counts = risk_engine.metrics_snapshot()['counters']
+    assert counts['history_writes'] == 1 and counts['history_unchanged'] == 1
+    assert len(stored_files(tmp_path)) == 1
+
+def test_old_versions_are_pruned(tmp_path):
+    entries = [risk_engine.save_snapshot(str(tmp_path), scored(["B1"], [float(i)], ["A"]), "2026-09",
+                                         keep_versions=2)
+               for i in range(4)]
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+    assert [v['version'] for v in manifest['periods']["2026-09"]['versions']] == [e['version'] for e in entries[2:]]
+    assert stored_files(tmp_path) == sorted(os.path.basename(e['file']) for e in entries[2:])
+    assert risk_engine.history_periods(str(tmp_path))["2026-09"] == entries[-1]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+def save_period(store, period):
+    return risk_engine.save_snapshot(store, scored(["B1"], [float(period[-2:])], ["A"]), period)
+
+def test_concurrent_processes_keep_every_period(tmp_path):
+    periods = [f"2026-{month:02d}" for month in range(1, 9)]
+    with ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context("spawn")) as pool:
+        entries = list(pool.map(save_period, [str(tmp_path)] * len(periods), periods))
+    assert risk_engine.history_periods(str(tmp_path)) == dict(zip(periods, entries))
+
+# ==========================================
+# BRANCH_HISTORY
+# ==========================================
+@pytest.fixture
+def store(tmp_path):
+    codes = [f"B{i:05d}" for i in range(40_000)]
+    rng = np.random.default_rng(0)
+    frames = {}
+    for period, drop in (("2026-07", None), ("2026-08", "B00007"), ("2026-09", None)):
+        scores = rng.integers(0, 10, len(codes)).astype(float)
+        grades = np.where(scores < 3, "A", np.where(scores < 7, "B", "C"))
+        df = scored(codes, scores, grades)
+        frames[period] = df[df['BranchCode'] != drop].reset_index(drop=True)
+        risk_engine.save_snapshot(str(tmp_path), frames[period], period)
+    return str(tmp_path), frames
+
+def test_branch_history_reads_each_period(store):
+    path, frames = store
+    history = risk_engine.branch_history(path, "B00007")
+    assert history.index.tolist() == ["2026-07", "2026-09"]
+    assert history.index.name == "Period"
+    for period in history.index:
+        expected = frames[period].set_index('BranchCode').loc["B00007"]
+        assert history.loc[period, 'Total Score'] == expected['Total Score']
+        assert history.loc[period, 'Final Grade'] == expected['Final Grade']
+    assert risk_engine.branch_history(path, "B00008", periods=["2026-09", "2025-01"]).index.tolist() == ["2026-09"]
+    assert risk_engine.branch_history(path, "missing").empty
+
+# ==========================================
+# PERIOD_MIGRATION
+# ==========================================
+def test_migration_matches_a_merge(store):
+    path, frames = store
+    migration = risk_engine.period_migration(path, "2026-08", "2026-09")
+    assert migration['new'] == 1 and migration['exited'] == 0
+
+    merged = frames["2026-08"].merge(frames["2026-09"], on='BranchCode', suffixes=(" before", " after"))
+    expected = pd.crosstab(merged['Final Grade before'].astype(str), merged['Final Grade after'].astype(str))
+    matrix = migration['matrix']
+    assert (matrix.index.name, matrix.columns.name) == ("2026-08", "2026-09")
+    assert (matrix.loc[expected.index, expected.columns].to_numpy() == expected.to_numpy()).all()
+    assert matrix.to_numpy().sum() == len(merged)
+
+    moved = merged[merged['Final Grade before'].astype(str) != merged['Final Grade after'].astype(str)]
+    changes = migration['changes']
+    assert changes['BranchCode'].tolist() == moved['BranchCode'].tolist()
+    assert changes['2026-09 Score'].tolist() == moved['Total Score after'].tolist()
+
+def test_missing_grades_migrate_as_na(tmp_path):
+    store = str(tmp_path)
+    risk_engine.save_snapshot(store, scored(["B1", "B2", "B3", "B4"], [1.0, 2.0, np.nan, 4.0],
+                                            ["A", "B", None, "N/A"]), "2026-08")
+    risk_engine.save_snapshot(store, scored(["B1", "B2", "B3", "B5"], [1.0, np.nan, 3.0, 5.0],
+                                            ["A", None, "C", "C"]), "2026-09")
+    migration = risk_engine.period_migration(store, "2026-08", "2026-09")
+    assert migration['new'] == 1 and migration['exited'] == 1
+    matrix = migration['matrix']
+    assert "nan" not in matrix.index
+    assert matrix.loc["A", "A"] == 1 and matrix.loc["B", "N/A"] == 1 and matrix.loc["N/A", "C"] == 1
+    assert matrix.to_numpy().sum() == 3
+    assert migration['changes']['BranchCode'].tolist() == ["B2", "B3"]
@@ -0,0 +1,197 @@
+"""
+Checks the compiled scoring and grading path against the original row-wise
+implementations, kept here verbatim as the reference behaviour.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from risk_engine import apply_rules_vectorized, assign_grades, compile_grades, score_workbook
+
+# ==========================================
+# REFERENCE IMPLEMENTATIONS (baseline dashboard)
+# ==========================================
+def reference_get_grade(score, df_grades):
+    try:
+        for _, row in df_grades.iterrows():
+            if row['Min Score'] <= score <= row['Max Score']:
+                return row['Grade']
+    except:
+        return "N/A"
+    return "N/A"
+
+def reference_apply_rules(df, df_rules, unique_params):
+    for param in unique_params:
+        if param in df.columns:
+            df[f"{param} Score"] = 0.0
+
+    for param in unique_params:
+        if param not in df.columns: continue
+        rules = df_rules[df_rules['Column Name'] == param]
+        is_assigned = pd.Series([False] * len(df), index=df.index)
+
+        for _, rule in rules.iterrows():
+            op = str(rule['Operator']).strip().upper()
+            val = rule['Value']
+            score = float(rule['Score'])
+            try:
+                col_data = df[param]
+                if op == "ALL" or op == "ELSE":
+                    current_mask = pd.Series([True] * len(df), index=df.index)
+                elif op == ">":
+                    current_mask = pd.to_numeric(col_data, errors='coerce') > float(val)
+                elif op == "<":
+                    current_mask = pd.to_numeric(col_data, errors='coerce') < float(val)
+                elif op in [">=", "=>"]:
+                    current_mask = pd.to_numeric(col_data, errors='coerce') >= float(val)
+                elif op in ["<=", "=<"]:
+                    current_mask = pd.to_numeric(col_data, errors='coerce') <= float(val)
+                elif op == "=":
+                    is_numeric_col = pd.to_numeric(col_data, errors='coerce').notna().all()
+                    if is_numeric_col:
+                        current_mask = pd.to_numeric(col_data, errors='coerce') == float(val)
+                    else:
+                        current_mask = col_data.astype(str).str.upper().str.strip() == str(val).upper().strip()
+                elif op == "<>":
+                    current_mask = col_data.astype(str).str.upper().str.strip() != str(val).upper().strip()
+                elif op == "CONTAINS":
+                    current_mask = col_data.astype(str).str.upper().str.contains(str(val).upper().strip(), na=False)
+                else:
+                    current_mask = pd.Series([False] * len(df), index=df.index)
+
+                current_mask = current_mask.fillna(False)
+                update_mask = current_mask & (~is_assigned)
+                if update_mask.any():
+                    df.loc[update_mask, f"{param} Score"] = score
+                    is_assigned = is_assigned | update_mask
+            except Exception as e:
+                continue
+
+    score_cols = [c for c in df.columns if c.endswith(" Score")]
+    df["Total Score"] = df[score_cols].sum(axis=1)
+    return df
+
+# ==========================================
+# HELPERS
+# ==========================================
+OPERATORS = [">", "<", ">=", "=>", "<=", "=<", "=", "<>", "CONTAINS", "ALL", "ELSE", " > ", "all", "??", "==", None]
+VALUES = [0, 1, 2, 3, 5.5, 10, -1, 0.5, "2", "3.5", "high", "LOW", " med ", "abc", "x", "[", "B0", "", np.nan]
+GRADES = pd.DataFrame({'Min Score': [0, 10, 20.5, 40], 'Max Score': [9, 20, 35, 100], 'Grade': ["D", "C", "B", "A"]})
+
+def random_data(rng, n):
+    return pd.DataFrame({
+        'BranchCode': [f"B{i:04d}" for i in range(n)],
+        'Num': rng.choice([1.0, 2.0, 3.0, np.nan, 5.5, 10.0, -1.0], n),
+        'Int': rng.integers(0, 10, n),
+        'Txt': pd.Series(rng.choice(["high", "Low ", " MED", "x", None], n), dtype=object),
+        'Mix': pd.Series(rng.choice([1, 2, "abc", 3.5, "", None, "2"], n), dtype=object),
+        'Pct': rng.random(n),
+    })
+
+def random_rules(rng):
+    rows = []
+    for column in ['Num', 'Int', 'Txt', 'Mix', 'Pct', 'BranchCode', 'Missing']:
+        for _ in range(rng.integers(0, 8)):
+            rows.append((column, OPERATORS[rng.integers(len(OPERATORS))], VALUES[rng.integers(len(VALUES))],
+                         rng.choice([0, 1, 2, 3.5, 5, np.nan])))
+    return pd.DataFrame(rows, columns=['Column Name', 'Operator', 'Value', 'Score'])
+
+def assert_scores_match(df, df_rules, **options):
+    unique_params = df_rules['Column Name'].unique()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = reference_apply_rules(df.copy(), df_rules, unique_params)
+        result = apply_rules_vectorized(df.copy(), df_rules, unique_params, **options)
+    pd.testing.assert_frame_equal(result, expected)
+    return result
+
+def assert_grades_match(scores, df_grades):
+    expected = pd.Series([reference_get_grade(s, df_grades) for s in scores], dtype=object)
+    result = assign_grades(pd.Series(scores), compile_grades(df_grades)).astype(object)
+    pd.testing.assert_series_equal(result, expected, check_names=False)
+
+def rules(*rows):
+    return pd.DataFrame(list(rows), columns=['Column Name', 'Operator', 'Value', 'Score'])
+
+# ==========================================
+# RANDOMIZED PARITY
+# ==========================================
+@pytest.mark.parametrize("seed", range(40))
+def test_random_rules_match_reference(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(5):
+        assert_scores_match(random_data(rng, int(rng.integers(0, 60))), random_rules(rng))
+
+@pytest.mark.parametrize("partition", ["params", "rows"])
+def test_parallel_scoring_matches_reference(partition):
+    rng = np.random.default_rng(99)
+    assert_scores_match(random_data(rng, 500), random_rules(rng), workers=2, partition=partition,
+                        min_parallel_rows=1)
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_scores_grade_like_reference(seed):
+    rng = np.random.default_rng(seed)
+    scores = np.round(rng.uniform(-5, 110, 200) * 2) / 2
+    scores[rng.random(200) < 0.05] = np.nan
+    assert_grades_match(scores, GRADES)
+
+def test_workbook_grades_match_reference():
+    rng = np.random.default_rng(7)
+    df, df_rules = random_data(rng, 300), random_rules(rng)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        result = score_workbook(df_rules, df.copy(), GRADES)
+    expected = [reference_get_grade(s, GRADES) for s in result['Total Score']]
+    assert list(result['Final Grade'].astype(object)) == expected
+
+# ==========================================
+# EDGE CASES
+# ==========================================
+def test_nan_values_never_match_comparisons():
+    df = pd.DataFrame({'Num': [np.nan, 1.0, np.nan, 4.0]})
+    result = assert_scores_match(df, rules(('Num', '>', 0, 5), ('Num', '<', 100, 3), ('Num', 'ELSE', None, 1)))
+    assert list(result['Num Score']) == [1.0, 5.0, 1.0, 5.0]
+
+def test_mixed_int_and_text_column():
+    df = pd.DataFrame({'Mix': pd.Series([1, "abc", 2.5, None, "3"], dtype=object)})
+    assert_scores_match(df, rules(('Mix', '>=', 2, 4), ('Mix', '=', "abc", 2), ('Mix', '<>', "3", 1)))
+
+def test_invalid_operators_and_values_are_skipped():
+    df = pd.DataFrame({'Num': [1.0, 2.0, 3.0]})
+    result = assert_scores_match(df, rules(('Num', '??', 1, 9), ('Num', '>', "high", 9), ('Num', None, 1, 9),
+                                           ('Num', '>=', 2, 1)))
+    assert list(result['Num Score']) == [0.0, 1.0, 1.0]
+
+def test_equality_is_numeric_only_for_fully_numeric_columns():
+    numeric = pd.DataFrame({'Code': [1, 2, 3]})
+    result = assert_scores_match(numeric, rules(('Code', '=', "2", 5), ('Code', '=', 2.0, 7)))
+    assert list(result['Code Score']) == [0.0, 5.0, 0.0]
+    # One non-numeric cell switches the whole column to case-insensitive text comparison
+    text = pd.DataFrame({'Code': pd.Series([1, 2, "two"], dtype=object)})
+    result = assert_scores_match(text, rules(('Code', '=', 2.0, 7), ('Code', '=', " TWO ", 3), ('Code', '=', "2", 5)))
+    assert list(result['Code Score']) == [0.0, 5.0, 3.0]
+
+def test_contains_matches_case_insensitive_patterns():
+    # An invalid pattern such as "[" skips the rule; missing cells follow the reference
+    df = pd.DataFrame({'Txt': pd.Series(["High risk", "low", None, "x[1]"], dtype=object)})
+    result = assert_scores_match(df, rules(('Txt', 'CONTAINS', " HIGH ", 5), ('Txt', 'CONTAINS', "ow", 2),
+                                           ('Txt', 'CONTAINS', "[", 1)))
+    assert list(result['Txt Score'].iloc[[0, 1, 3]]) == [5.0, 2.0, 0.0]
+
+def test_first_matching_rule_wins_on_overlaps():
+    df = pd.DataFrame({'Num': [5.0, 15.0, 25.0]})
+    result = assert_scores_match(df, rules(('Num', '>', 10, 3), ('Num', '>', 20, 9), ('Num', 'ALL', None, 1)))
+    assert list(result['Num Score']) == [1.0, 3.0, 3.0]
+
+def test_scores_between_grade_bands():
+    assert_grades_match([9.0, 9.5, 20.0, 20.25, 20.5, 35.5, 39.99, 40.0, -0.1, 100.01], GRADES)
+    overlapping = pd.DataFrame({'Min Score': [0, 5, 50], 'Max Score': [10, 60, 40], 'Grade': ["Low", "Mid", "Empty"]})
+    assert_grades_match([0, 5, 7.5, 10, 10.5, 45, 60, 61], overlapping)
+
+def test_malformed_grade_rows():
+    blank = pd.DataFrame({'Min Score': [0, 10], 'Max Score': [9, 20], 'Grade': ["B", np.nan]})
+    assert_grades_match([3, 9.5, 15], blank)
+    text_bound = pd.DataFrame({'Min Score': [0, "ten"], 'Max Score': [9, 20], 'Grade': ["B", "A"]})
+    assert_grades_match([3, 15], text_bound)
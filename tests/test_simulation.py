@@ -0,0 +1,85 @@
+"""
+Checks what-if simulations against a full score_workbook run of the same
+Sheet1 and Sheet3, for the baseline and for changed rules and grades.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from risk_engine import new_simulation, scenario_deltas, shift_rule_value, simulate_scenarios, score_workbook
+from test_parity import GRADES, random_data, random_rules, rules
+
+def full_rescore(df, df_rules, df_grades):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return score_workbook(df_rules, df.copy(), df_grades)
+
+def assert_matches_rescore(sim, result, df_rules, df_grades):
+    expected = full_rescore(sim['df'], df_rules, df_grades)
+    np.testing.assert_array_equal(result['total'], expected['Total Score'].to_numpy())
+    assert list(np.asarray(result['grades'], dtype=object)) == list(expected['Final Grade'].astype(object))
+
+def changed_rules(rng, df_rules):
+    # Same parameters as the baseline, with shuffled and partly blank scores and shifted thresholds
+    scores = rng.permutation(df_rules['Score'].to_numpy())
+    scores[rng.random(len(scores)) < 0.2] = np.nan
+    values = [v + 1 if isinstance(v, (int, float)) and not pd.isna(v) and rng.random() < 0.5 else v
+              for v in df_rules['Value']]
+    return df_rules.assign(Score=scores, Value=values)
+
+def simulate(df, df_rules, df_grades, scenarios):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        sim = new_simulation(df, df_rules, df_grades)
+        return sim, simulate_scenarios(sim, scenarios)
+
+def test_blank_score_counts_as_zero():
+    df = pd.DataFrame({'BranchCode': ["a", "b"], 'X': [3, 1], 'Y': [0, 0]})
+    df_rules = rules(('X', '>', 2, np.nan), ('X', 'ELSE', None, 1), ('Y', 'ELSE', None, 2))
+    sim, results = simulate(df, df_rules, GRADES, {'base': df_rules})
+    assert list(results['base']['total']) == [2.0, 3.0]
+    assert_matches_rescore(sim, results['base'], df_rules, GRADES)
+
+@pytest.mark.parametrize("seed", range(40))
+def test_random_scenarios_match_full_rescore(seed):
+    rng = np.random.default_rng(seed)
+    df, df_rules = random_data(rng, int(rng.integers(1, 80))), random_rules(rng)
+    changed = changed_rules(rng, df_rules)
+    bands = GRADES.assign(**{'Max Score': [4, 12, 30, 100]})
+    sim, results = simulate(df, df_rules, GRADES, {
+        'base': df_rules,
+        'changed': changed,
+        'bands': {'grades': bands},
+        'both': {'rules': changed, 'grades': bands},
+    })
+    assert_matches_rescore(sim, results['base'], df_rules, GRADES)
+    assert_matches_rescore(sim, results['changed'], changed, GRADES)
+    assert_matches_rescore(sim, results['bands'], df_rules, bands)
+    assert_matches_rescore(sim, results['both'], changed, bands)
+
+def test_deltas_and_migration_follow_the_changed_rows():
+    df = pd.DataFrame({'BranchCode': ["a", "b", "c", "d"], 'X': [1.0, 5.0, 12.0, 30.0]})
+    df_rules = rules(('X', '>', 10, 15), ('X', 'ALL', None, 2))
+    shifted = shift_rule_value(df_rules, 'X', 10, 4)
+    sim, results = simulate(df, df_rules, GRADES, {'shift': shifted})
+    result = results['shift']
+    assert_matches_rescore(sim, result, shifted, GRADES)
+    assert result['changed_params'] == ['X']
+    assert result['moved'] == 1
+    assert result['migration'].loc['D', 'C'] == 1
+    deltas = scenario_deltas(sim, result)
+    assert list(deltas['BranchCode']) == ["b"]
+    assert list(deltas['Delta']) == [13.0]
+
+def test_column_cache_stays_within_budget():
+    rng = np.random.default_rng(3)
+    df, df_rules = random_data(rng, 2000), random_rules(rng)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        sim = new_simulation(df, df_rules, GRADES, max_mb=0.05)
+        for i in range(5):
+            simulate_scenarios(sim, {i: changed_rules(rng, df_rules)})
+    assert sim['scores_bytes'] <= max(sim['max_bytes'], 2000 * 8)
+    assert sim['scores_bytes'] == sum(s.nbytes for s in sim['scores'].values())